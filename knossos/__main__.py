@@ -100,6 +100,20 @@ elif len(sys.argv) > 1 and sys.argv[1] == '--lib-paths':
         'sdl2': clibs.sdl._name if clibs.sdl else None,
         'openal': clibs.alc._name if clibs.alc else None
     }))
+elif len(sys.argv) > 2 and sys.argv[1] == '--import-archives':
+    # Seed the archive cache with already downloaded archives.
+    from knossos import launcher, util, center
+
+    launcher.load_settings()
+    cache = util.get_archive_cache()
+
+    if not cache:
+        print('The archive cache is disabled or the library path is not set.')
+        sys.exit(1)
+
+    count = cache.import_folder(sys.argv[2], lambda path: util.gen_hash(path)[1])
+    util.HASH_CACHE.close()
+    print('Imported %d archives into %s.' % (count, cache.path))
 else:
     from knossos import launcher
     launcher.main()
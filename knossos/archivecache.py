@@ -0,0 +1,242 @@
+## Copyright 2017 Knossos authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import re
+import shutil
+import logging
+import tempfile
+from threading import Lock
+
+
+class ArchiveCache(object):
+    """Keeps downloaded archives around so they don't have to be downloaded again.
+
+    Archives are stored by their sha256 checksum (<path>/ab/abcdef...). The mtime of each file is used to track when
+    it was last used. Once the cache grows beyond max_size bytes, the least recently used archives are removed.
+
+    Archives which are still in use can be pinned (see get() and add()). Pinned archives are never evicted until
+    release() was called as often as they were pinned.
+
+    If a hash_cache is given, the checksums of all stored archives are recorded in it. Its entries are kept up to date
+    when the mtime changes so cache hits don't have to be hashed again.
+    """
+
+    _name_re = re.compile(r'^[0-9a-f]{64}$')
+
+    def __init__(self, path, max_size, hash_cache=None):
+        self.path = path
+        self.max_size = max_size
+        self.hash_cache = hash_cache
+        self._lock = Lock()
+        self._pins = {}
+        self._pin_lock = Lock()
+
+    def _get_path(self, chksum):
+        return os.path.join(self.path, chksum[:2], chksum)
+
+    def _touch(self, path):
+        """Marks the archive at path as recently used."""
+        path = os.path.abspath(path)
+        chksum = self.hash_cache.get(path, os.stat(path)) if self.hash_cache else None
+
+        os.utime(path, None)
+
+        # The hash cache entry is only valid for the old mtime.
+        if chksum:
+            self.hash_cache.put(path, os.stat(path), chksum)
+
+    def _seed(self, path, chksum):
+        if self.hash_cache:
+            path = os.path.abspath(path)
+            self.hash_cache.put(path, os.stat(path), chksum)
+
+    def _pin(self, chksum):
+        with self._pin_lock:
+            self._pins[chksum] = self._pins.get(chksum, 0) + 1
+
+    def release(self, chksum):
+        """Unpins an archive which was pinned by get() or add()."""
+        with self._pin_lock:
+            count = self._pins.get(chksum, 0) - 1
+            if count > 0:
+                self._pins[chksum] = count
+            else:
+                self._pins.pop(chksum, None)
+
+    def _is_pinned(self, chksum):
+        with self._pin_lock:
+            return chksum in self._pins
+
+    def get(self, chksum, pin=False):
+        """Returns the path to the cached archive with the given checksum or None.
+
+        If pin is True and the archive was found, it's pinned and the caller has to release() it.
+        """
+        if not self._name_re.match(chksum):
+            return None
+
+        if pin:
+            # Pin first, otherwise the archive could be evicted between the check below and the pin.
+            self._pin(chksum)
+
+        path = self._get_path(chksum)
+        try:
+            self._touch(path)
+        except OSError:
+            if pin:
+                self.release(chksum)
+
+            return None
+
+        return path
+
+    def add(self, src_path, chksum, move=False, pin=False):
+        """Stores src_path in the cache and returns the cached copy's path.
+
+        If move is True, src_path is moved into the cache instead of being copied. The caller has to make sure that
+        chksum is correct. If pin is True, the caller has to release() the archive once it's done with it.
+
+        Archives which are larger than the whole cache aren't stored. In that case, None is returned and src_path is
+        left alone.
+        """
+        if not self._name_re.match(chksum):
+            raise ValueError('Invalid checksum "%s"!' % chksum)
+
+        if os.path.getsize(src_path) > self.max_size:
+            logging.debug('Not caching "%s" since it\'s larger than the archive cache.' % src_path)
+            return None
+
+        # The new archive must not be evicted by the evict() call below (or by a parallel add()).
+        self._pin(chksum)
+        try:
+            return self._add(src_path, chksum, move)
+        finally:
+            if not pin:
+                self.release(chksum)
+
+    def _add(self, src_path, chksum, move):
+        dest_path = self._get_path(chksum)
+        if os.path.isfile(dest_path):
+            os.utime(dest_path, None)
+            self._seed(dest_path, chksum)
+
+            if move:
+                os.unlink(src_path)
+
+            return dest_path
+
+        parent = os.path.dirname(dest_path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+
+        if move:
+            try:
+                os.replace(src_path, dest_path)
+            except OSError:
+                # Probably a different file system.
+                move = False
+
+        if not move:
+            # Copy to a temporary name first so other threads never see a partial archive.
+            fd, tmp_path = tempfile.mkstemp(dir=parent, prefix='.tmp')
+            os.close(fd)
+
+            try:
+                shutil.copyfile(src_path, tmp_path)
+                os.replace(tmp_path, dest_path)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+
+            # The copy should count as recently used.
+            os.utime(dest_path, None)
+
+        self._seed(dest_path, chksum)
+        self.evict()
+        return dest_path
+
+    def remove(self, chksum):
+        try:
+            os.unlink(self._get_path(chksum))
+        except OSError:
+            pass
+
+    def get_entries(self):
+        """Returns a list of (mtime, size, path) tuples for all cached archives."""
+        entries = []
+        if not os.path.isdir(self.path):
+            return entries
+
+        with os.scandir(self.path) as it:
+            for sub in it:
+                if not sub.is_dir():
+                    continue
+
+                with os.scandir(sub.path) as sub_it:
+                    for item in sub_it:
+                        if self._name_re.match(item.name):
+                            info = item.stat()
+                            entries.append((info.st_mtime, info.st_size, item.path))
+
+        return entries
+
+    def get_size(self):
+        return sum(size for _, size, _ in self.get_entries())
+
+    def evict(self):
+        with self._lock:
+            entries = self.get_entries()
+            total = sum(size for _, size, _ in entries)
+            if total <= self.max_size:
+                return
+
+            entries.sort()
+            for mtime, size, path in entries:
+                if self._is_pinned(os.path.basename(path)):
+                    continue
+
+                try:
+                    os.unlink(path)
+                except OSError:
+                    # Windows won't let us delete archives which are being extracted right now.
+                    logging.debug('Failed to evict "%s" from the archive cache.' % path)
+                    continue
+
+                total -= size
+                if total <= self.max_size:
+                    break
+
+    def import_folder(self, folder, hash_fn):
+        """Copies all .7z archives from folder into the cache. hash_fn(path) has to return the file's sha256 checksum.
+
+        Returns the number of imported archives.
+        """
+        count = 0
+
+        for path, dirs, files in os.walk(folder):
+            for name in files:
+                if not name.lower().endswith('.7z'):
+                    continue
+
+                src_path = os.path.join(path, name)
+                try:
+                    if self.add(src_path, hash_fn(src_path)):
+                        count += 1
+                except Exception:
+                    logging.exception('Failed to import "%s" into the archive cache!' % src_path)
+
+        return count
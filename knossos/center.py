@@ -71,12 +71,21 @@ settings = {
     'base_dirs': [],
     'custom_bar': True,
     'hash_cache': None,
+    'archive_cache_size': 4 * 1024 ** 3,  # Bytes, 0 disables the archive cache
+    'mirror_scores': {},
     'max_downloads': 3,
+    # If enabled, max_downloads is only the starting point and the number of parallel downloads is adjusted
+    # between download_slots_min and download_slots_max depending on the measured throughput.
+    'download_autotune': True,
+    'download_slots_min': 1,
+    'download_slots_max': 10,
     'download_bandwidth': -1.0,  # negative numbers are used to specify no limit
+    'background_bandwidth': -1.0,  # Limit for background downloads (i.e. mod images), applied on top of the above
     'repos_override': [],
     'api_override': None,
     'web_override': None,
     'update_notify': True,
+    'check_before_launch': True,  # Runs a quick CheckFilesTask before a mod is launched
     'fetch_interval': 'hourly',
     'use_raven': True,
     'sdl2_path': None,
@@ -127,6 +136,7 @@ else:
 class _SignalContainer(QtCore.QObject):
     update_avail = QtCore.Signal('QVariant')
     task_launched = QtCore.Signal(QtCore.QObject)
+    mod_list_changed = QtCore.Signal()
 
 
 signals = _SignalContainer()
@@ -135,13 +145,9 @@ def get_library_json_name():
     return 'kn_library.json'
 
 def save_settings():
-    settings['hash_cache'] = dict()
-
-    # Other threads might be using the hash cache. Make a local copy to avoid problems.
-    for path, info in list(util.HASH_CACHE.items()):
-        # Skip deleted files
-        if os.path.exists(path):
-            settings['hash_cache'][path] = info
+    # The hash cache has its own database (see launcher.load_settings()), just make sure it's written to disk.
+    util.HASH_CACHE.flush()
+    settings['mirror_scores'] = util.MIRRORS.dump()
 
     with open(os.path.join(settings_path, 'settings.json'), 'w', errors='replace') as stream:
         json.dump(settings, stream)
@@ -25,7 +25,7 @@ import hashlib
 if __name__ == '__main__':
     sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
-from knossos import progress, vplib
+from knossos import progress, util, vplib
 
 ADAPTERS = {}
 
@@ -38,49 +38,6 @@ def register(ext):
     return wrapper
 
 
-class SubFile(object):
-    _pos = 0
-
-    def __init__(self, handle, length):
-        self._handle = handle
-        self._length = length
-        self._offset = handle.tell()
-
-    def read(self, length=None):
-        if length is None or self._pos + length > self._length:
-            length = self._length - self._pos
-
-        if length == 0:
-            return None
-
-        self._handle.seek(self._offset + self._pos)
-        try:
-            return self._handle.read(length)
-        finally:
-            self._pos = self._handle.tell() - self._offset
-
-    def tell(self):
-        return self._pos
-
-    def seek(self, pos, mode=os.SEEK_SET):
-        if mode == os.SEEK_CUR:
-            pos += self._pos
-        elif mode == os.SEEK_END:
-            pos = self._length - pos
-
-        self._handle.seek(self._offset + pos)
-        self._pos = pos
-
-    def close(self):
-        self._handle = None
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, *exc):
-        self.close()
-
-
 class ArchiveAdapter(object):
 
     def __init__(self, handle):
@@ -104,16 +61,9 @@ class ArchiveAdapter(object):
         if fn in self._cache:
             return self._cache[fn]
 
-        h = hashlib.sha256()
         with self.handle(fn) as stream:
-            while True:
-                chunk = stream.read(16 * h.block_size)
-                if not chunk:
-                    break
-
-                h.update(chunk)
+            self._cache[fn] = util.hash_stream(stream)
 
-        self._cache[fn] = h.hexdigest()
         return self._cache[fn]
 
     def write_file(self, fn, path):
@@ -227,7 +177,17 @@ class VpAdapter(ArchiveAdapter):
         return self._handle.files.keys()
 
     def handle(self, fn):
-        return SubFile(self._handle.open_file(fn), self._handle.files[fn]['size'])
+        return self._handle.open_file(fn)
+
+    def hash(self, fn):
+        if fn not in self._cache:
+            buf = self._handle.get_buffer(fn)
+            try:
+                self._cache[fn] = hashlib.sha256(buf).hexdigest()
+            finally:
+                buf.release()
+
+        return self._cache[fn]
 
     def write(self, fn, gen_out=False):
         if not self._list:
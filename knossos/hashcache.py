@@ -0,0 +1,188 @@
+## Copyright 2017 Knossos authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import time
+import logging
+import sqlite3
+from threading import Lock
+
+
+class HashCache(object):
+    """Remembers the sha256 checksums of local files in a SQLite database.
+
+    Entries are looked up by path first. If the path is unknown (or outdated), the file's identity
+    (device, inode, size, mtime) is used instead which means that moved files (i.e. after the user changed the
+    base path) don't have to be hashed again.
+
+    The database is only opened once it's needed. Writes are batched and committed every commit_interval changes
+    or when flush() is called. The least recently used entries are evicted once there are more than max_entries.
+    """
+
+    max_entries = 500000
+    commit_interval = 1000
+
+    def __init__(self, path=None):
+        # Without a path the cache only lives in memory.
+        self.path = path
+        self._conn = None
+        self._lock = Lock()
+        self._pending = 0
+        self._used = set()
+
+    def _connect(self):
+        if self._conn is not None:
+            return self._conn
+
+        path = self.path or ':memory:'
+        try:
+            self._conn = self._open(path)
+        except sqlite3.DatabaseError:
+            logging.exception('Failed to open the hash cache "%s"! Starting with an empty cache.' % path)
+
+            try:
+                os.unlink(path)
+                self._conn = self._open(path)
+            except (OSError, sqlite3.DatabaseError):
+                logging.exception('Failed to recreate the hash cache. Using a temporary one instead.')
+                self._conn = self._open(':memory:')
+
+        return self._conn
+
+    def _open(self, path):
+        if path != ':memory:':
+            base = os.path.dirname(path)
+            if base and not os.path.isdir(base):
+                os.makedirs(base)
+
+        conn = sqlite3.connect(path, check_same_thread=False)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('''CREATE TABLE IF NOT EXISTS hashes (
+                path TEXT PRIMARY KEY,
+                dev INTEGER NOT NULL,
+                ino INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                chksum TEXT NOT NULL,
+                used INTEGER NOT NULL
+            )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS hashes_ident ON hashes (dev, ino, size, mtime)')
+            conn.execute('CREATE INDEX IF NOT EXISTS hashes_used ON hashes (used)')
+            conn.commit()
+        except sqlite3.DatabaseError:
+            conn.close()
+            raise
+
+        return conn
+
+    def get(self, path, info):
+        """Returns the cached checksum for path or None.
+
+        info has to be the result of os.stat(path).
+        """
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute('SELECT ino, size, mtime, chksum FROM hashes WHERE path = ?', (path,)).fetchone()
+
+            # If the inode changed, the file was replaced (i.e. by a copy which preserved the mtime).
+            if row and row[0] in (info.st_ino, 0) and row[1] == info.st_size and row[2] == info.st_mtime_ns:
+                self._used.add(path)
+                return row[3]
+
+            if info.st_ino == 0:
+                # Without an inode number (some network filesystems) we can't identify files reliably.
+                return None
+
+            row = conn.execute('SELECT chksum FROM hashes WHERE dev = ? AND ino = ? AND size = ? AND mtime = ? LIMIT 1',
+                               (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns)).fetchone()
+
+            if row:
+                # The file was moved (or is a hardlink). Remember the new path as well.
+                self._put(path, info, row[0])
+                return row[0]
+
+        return None
+
+    def put(self, path, info, chksum):
+        with self._lock:
+            self._connect()
+            self._put(path, info, chksum)
+
+    def _put(self, path, info, chksum):
+        self._conn.execute('INSERT OR REPLACE INTO hashes (path, dev, ino, size, mtime, chksum, used) VALUES '
+                           '(?, ?, ?, ?, ?, ?, ?)', (path, info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns,
+                                                     chksum, int(time.time())))
+        self._used.discard(path)
+
+        self._pending += 1
+        if self._pending >= self.commit_interval:
+            self._commit()
+
+    def _commit(self):
+        if self._used:
+            now = int(time.time())
+            self._conn.executemany('UPDATE hashes SET used = ? WHERE path = ?', [(now, p) for p in self._used])
+            self._used.clear()
+
+        count = self._conn.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+        if count > self.max_entries:
+            logging.debug('Evicting %d entries from the hash cache.' % (count - self.max_entries))
+            self._conn.execute('DELETE FROM hashes WHERE path IN (SELECT path FROM hashes ORDER BY used LIMIT ?)',
+                               (count - self.max_entries,))
+
+        self._conn.commit()
+        self._pending = 0
+
+    def import_legacy(self, entries):
+        """Imports the old settings.json hash cache which maps paths to (checksum, mtime) pairs."""
+        count = 0
+
+        with self._lock:
+            self._connect()
+
+            for path, (chksum, mtime) in entries.items():
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+
+                if info.st_mtime == mtime:
+                    self._put(path, info, chksum)
+                    count += 1
+
+            self._commit()
+
+        logging.info('Imported %d entries into the hash cache.' % count)
+
+    def flush(self):
+        with self._lock:
+            if self._conn is not None:
+                self._commit()
+
+    def clear(self):
+        with self._lock:
+            self._connect().execute('DELETE FROM hashes')
+            self._used.clear()
+            self._commit()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._commit()
+                self._conn.close()
+                self._conn = None
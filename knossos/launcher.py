@@ -68,7 +68,8 @@ if six.PY2:
     from . import py2_compat  # noqa
 
 from .qt import QtCore, QtGui, QtWidgets, variant as qt_variant
-from . import util, ipc, auto_fetch
+from . import util, ipc, auto_fetch, vplib
+from .hashcache import HashCache
 
 
 app = None
@@ -155,8 +156,15 @@ def load_settings():
         # Most recent settings version
         settings['s_version'] = 6
 
+    util.HASH_CACHE = HashCache(os.path.join(center.settings_path, 'hash_cache.sqlite'))
     if settings['hash_cache'] is not None:
-        util.HASH_CACHE = settings['hash_cache']
+        # Older versions stored the hash cache in settings.json.
+        util.HASH_CACHE.import_legacy(settings['hash_cache'])
+        settings['hash_cache'] = None
+
+    util.MIRRORS.load(settings['mirror_scores'])
+    vplib.TOC_CACHE = vplib.TocCache(os.path.join(center.settings_path, 'vp_cache'))
+    vplib.TOC_CACHE.prune()
 
     if settings['use_raven']:
         util.enable_raven()
@@ -198,9 +206,9 @@ def run_knossos():
             'launcher', 'I can\'t find "7z"! Please install it and run this program again.'))
         return
 
-    util.DL_POOL.set_capacity(center.settings['max_downloads'])
-    if center.settings['download_bandwidth'] > 0.0:
-        util.SPEED_LIMIT_BUCKET.set_rate(center.settings['download_bandwidth'])
+    util.configure_downloads()
+    util.SPEED_LIMIT_BUCKET.set_rate(center.settings['download_bandwidth'])
+    util.BACKGROUND_LIMIT.set_rate(center.settings['background_bandwidth'])
 
     from . import repo, progress, integration
 
@@ -0,0 +1,153 @@
+## Copyright 2017 Knossos authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import json
+import logging
+from threading import Lock
+
+
+class LibraryIndex(object):
+    """Remembers the contents of the mod.json and user.json files of all installed mods.
+
+    Each entry is stored together with the size and mtime of its source files. An entry is only used as long as
+    these still match so mods which were changed in the meantime are read from disk again.
+
+    The JSON data is kept as text and only parsed when it's requested. Every caller gets its own copy which it can
+    modify freely.
+    """
+
+    version = 1
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        self._changed = False
+        self._lock = Lock()
+
+    def _get_stamp(self, path):
+        try:
+            info = os.stat(path)
+        except OSError:
+            return None
+
+        return [info.st_mtime_ns, info.st_size]
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+
+        try:
+            with open(self.path, 'r') as stream:
+                data = json.load(stream)
+        except Exception:
+            logging.exception('Failed to load the library index "%s"!' % self.path)
+            return
+
+        if data.get('version') != self.version:
+            logging.info('Ignoring the library index "%s" since it was written by a different version.' % self.path)
+            return
+
+        with self._lock:
+            self._entries = data.get('mods', {})
+
+    def save(self):
+        with self._lock:
+            if not self._changed:
+                return
+
+            data = {'version': self.version, 'mods': self._entries}
+            self._changed = False
+
+        # Write to a temporary file first so a crash never leaves a broken index behind.
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as stream:
+                json.dump(data, stream)
+
+            os.replace(tmp_path, self.path)
+        except Exception:
+            logging.exception('Failed to save the library index "%s"!' % self.path)
+
+    def get_folders(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def get(self, folder):
+        """Returns the (mod data, user data) for the mod in folder or None if the entry is missing or outdated."""
+        with self._lock:
+            entry = self._entries.get(folder)
+
+        if entry is None:
+            return None
+
+        if entry['stamp'] != self._get_stamp(os.path.join(folder, 'mod.json')):
+            return None
+
+        if entry['user_stamp'] != self._get_stamp(os.path.join(folder, 'user.json')):
+            return None
+
+        user = entry['user']
+        return json.loads(entry['mod']), json.loads(user) if user is not None else None
+
+    def read(self, folder):
+        """Like get() but reads outdated entries from disk (and updates the index)."""
+        result = self.get(folder)
+        if result is not None:
+            return result
+
+        mod_path = os.path.join(folder, 'mod.json')
+        user_path = os.path.join(folder, 'user.json')
+
+        # Take the stamps first. If a file changes while we read it, the next read will notice.
+        stamp = self._get_stamp(mod_path)
+        user_stamp = self._get_stamp(user_path)
+
+        with open(mod_path, 'r') as stream:
+            mod_text = stream.read()
+
+        mod_data = json.loads(mod_text)
+        user_text = None
+        user_data = None
+
+        if user_stamp is not None:
+            try:
+                with open(user_path, 'r') as stream:
+                    user_text = stream.read()
+
+                user_data = json.loads(user_text)
+            except Exception:
+                logging.exception('Failed to load user data from "%s"!' % user_path)
+                user_text = None
+
+        with self._lock:
+            self._entries[folder] = {
+                'stamp': stamp,
+                'user_stamp': user_stamp if user_text is not None else None,
+                'mod': mod_text,
+                'user': user_text
+            }
+            self._changed = True
+
+        return mod_data, user_data
+
+    def prune(self, folders):
+        """Removes all entries except the ones for the given folders."""
+        with self._lock:
+            for folder in list(self._entries.keys()):
+                if folder not in folders:
+                    del self._entries[folder]
+                    self._changed = True
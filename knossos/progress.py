@@ -17,6 +17,7 @@ from __future__ import absolute_import, print_function
 import sys
 import logging
 import threading
+from collections import deque
 import six
 
 from . import uhf
@@ -93,6 +94,21 @@ def update(prog, text=''):
 
 
 # Task scheduler
+PRIORITY_BACKGROUND = 1
+PRIORITY_FOREGROUND = 4
+
+
+def resources_overlap(a, b):
+    """Returns True if the resource names a and b refer to the same thing.
+
+    Names can be nested with colons: "mod" covers all mods and conflicts with "mod:FS2".
+    """
+    if a == b:
+        return True
+
+    return a.startswith(b + ':') or b.startswith(a + ':')
+
+
 class Worker(threading.Thread):
     busy = False
 
@@ -138,14 +154,33 @@ class Worker(threading.Thread):
 
 
 class Master(object):
+    """Distributes the work of all queued tasks to the worker threads.
+
+    Each task declares the resources it uses (see Task.resources). Tasks whose resources don't conflict run
+    concurrently, a task which conflicts with a running task waits until it's done. Waiting tasks are admitted in the
+    order of their priority (foreground tasks first) and otherwise in the order they were added. While several tasks
+    are running, each worker picks the task with the fewest work items in flight relative to its priority.
+    """
     _tasks = None
+    _active = None
     _tasks_lock = None
     _workers = None
     _stop_workers = False
     _worker_cond = None
+    _wake_gen = 0
+
+    # How many running tasks can use these resources at the same time (None means any number). All other resources
+    # are exclusive. "installed:read" is used by tasks which only read the installed mods repo. It still conflicts
+    # with "installed" which is used by tasks that modify it.
+    resource_limits = {
+        'net': 4,
+        'disk': 2,
+        'installed:read': None
+    }
 
     def __init__(self):
         self._tasks = []
+        self._active = []
         self._tasks_lock = threading.Lock()
         self._workers = []
         self._worker_cond = threading.Condition()
@@ -166,23 +201,90 @@ class Master(object):
         self._stop_workers = False
         self._workers = []
         self._tasks = []
+        self._active = []
+
+    def _conflicts(self, resources, claimed):
+        # resources is None for tasks which didn't declare anything. These can't share anything with other tasks.
+        if resources is None:
+            return len(claimed) > 0
+
+        if None in claimed:
+            return True
+
+        for name in resources:
+            limit = self.resource_limits.get(name, 1)
+            users = 0
+
+            for other in claimed:
+                for item in other:
+                    if resources_overlap(name, item):
+                        # Only identical names can be shared, "mod" vs. "mod:FS2" or "installed" vs.
+                        # "installed:read" always conflict.
+                        if item != name:
+                            return True
+
+                        users += 1
+                        break
+
+            if limit is not None and users >= limit:
+                return True
+
+        return False
+
+    def _get_waiting(self):
+        # Stable sort: Tasks with the same priority stay in the order they were added in.
+        waiting = [task for task in self._tasks if task not in self._active]
+        waiting.sort(key=lambda task: -task.get_priority())
+        return waiting
+
+    def _release_tasks(self):
+        # Has to be called with _tasks_lock held.
+        # A task leaves the queue as soon as its work list is empty but its last work items might still be running.
+        # Only release its resources once they're done.
+        released = False
+        for task in self._active[:]:
+            if task not in self._tasks and task._pending == 0:
+                self._active.remove(task)
+                released = True
+
+        return released
+
+    def _admit_tasks(self):
+        # Has to be called with _tasks_lock held.
+        self._release_tasks()
+        claimed = [task.resources for task in self._active]
+
+        for task in self._get_waiting():
+            if not self._conflicts(task.resources, claimed):
+                self._active.append(task)
+                logging.debug('Starting task %s.', task.__class__.__name__)
+
+            # A waiting task blocks the tasks behind it from taking its resources. Otherwise a steady stream of
+            # small tasks could keep it waiting forever.
+            claimed.append(task.resources)
 
     def _get_work(self):
         while True:
             if self._stop_workers:
                 return None
 
+            # Remember which wake up we've seen. If new work arrives while we're looking, we won't go to sleep.
+            gen = self._wake_gen
+
             with self._tasks_lock:
-                # Only run one task at once to avoid problems caused by multiple tasks modifying
-                # the installed mods repo.
-                if self._tasks:
-                    work = self._tasks[0]._get_work()
+                self._admit_tasks()
+
+                # Share the workers fairly: Prefer the task with the fewest work items in flight per priority unit.
+                order = sorted(self._active, key=lambda task: task._pending / float(task.get_priority()))
+                for task in order:
+                    work = task._get_work()
                     if work is not None:
                         return work
 
             # No work here... let's wait for more.
             with self._worker_cond:
-                self._worker_cond.wait()
+                if gen == self._wake_gen and not self._stop_workers:
+                    self._worker_cond.wait()
 
     def add_task(self, task):
         if not task._has_work():
@@ -200,8 +302,7 @@ class Master(object):
 
         task.done.connect(self.check_tasks)
 
-        with self._worker_cond:
-            self._worker_cond.notify_all()
+        self.wake_workers()
 
     def check_tasks(self):
         with self._tasks_lock:
@@ -214,13 +315,53 @@ class Master(object):
                     if self._tasks:
                         self.wake_workers()
 
-    def wake_workers(self):
+            if self._release_tasks() and self._tasks:
+                self.wake_workers()
+
+    def wake_workers(self, count=None):
+        # Wakes count idle workers or all of them if count is None.
         with self._worker_cond:
-            self._worker_cond.notify_all()
+            self._wake_gen += 1
+
+            if count is None:
+                self._worker_cond.notify_all()
+            else:
+                self._worker_cond.notify(count)
 
     def is_busy(self):
         return any([w.busy for w in self._workers])
 
+    def get_queue(self):
+        """Returns a list with one dict for each queued task.
+
+        The running tasks come first followed by the waiting ones in the order they'll be started in. blocked_by lists
+        the tasks ahead of a waiting task which use a resource it needs.
+        """
+        with self._tasks_lock:
+            queue = []
+            ahead = []
+            for task in self._active + self._get_waiting():
+                running = task in self._active
+                blocked_by = []
+
+                if not running:
+                    for other in ahead:
+                        if self._conflicts(task.resources, [other.resources]):
+                            blocked_by.append(other)
+
+                ahead.append(task)
+
+                queue.append({
+                    'task': task,
+                    'title': task.title,
+                    'running': running,
+                    'priority': task.get_priority(),
+                    'resources': task.resources,
+                    'blocked_by': blocked_by
+                })
+
+            return queue
+
 
 class Task(QtCore.QObject):
     _results = None
@@ -241,6 +382,11 @@ class Task(QtCore.QObject):
     _slot_prog = None
     _thread_prog = None
     background = False
+    # The resources this task uses (i.e. "net", "disk", "installed", "installed:read" or "mod:<mid>"). Tasks which
+    # don't declare anything (None) never run concurrently with other tasks.
+    resources = None
+    # If priority is None, it's derived from background.
+    priority = None
     can_abort = True
     aborted = False
     title = None
@@ -255,8 +401,8 @@ class Task(QtCore.QObject):
             work = []
 
         self._results = []
-        self._work = work
-        self._work_count = len(work)
+        self._work = deque(work)
+        self._work_count = len(self._work)
         self._result_lock = threading.Lock()
         self._work_lock = threading.Lock()
         self._done = threading.Event()
@@ -274,11 +420,17 @@ class Task(QtCore.QObject):
                 return None
             else:
                 self._pending += 1
-                return (self, (self._work.pop(0),))
+                return (self, (self._work.popleft(),))
 
     def _has_work(self):
-        with self._work_lock:
-            return len(self._work) > 0
+        # len() on a deque is atomic so the Master can poll this without taking the lock.
+        return len(self._work) > 0
+
+    def get_priority(self):
+        if self.priority is not None:
+            return self.priority
+
+        return PRIORITY_BACKGROUND if self.background else PRIORITY_FOREGROUND
 
     def _init(self):
         with self._progress_lock:
@@ -318,7 +470,15 @@ class Task(QtCore.QObject):
             self._results.append(result)
 
     def add_work(self, work):
-        if len(work) == 0:
+        self.add_work_many(work)
+
+    def add_work_many(self, items):
+        """Queues all items at once and wakes at most as many workers as there's new work for.
+
+        items can be any iterable.
+        """
+        items = list(items)
+        if len(items) == 0:
             # If self._work is empty after we're done, it will trip the empty task detection in add_task
             # which will cause us to finish too early. The easiest way to avoid this is to never call add_work()
             # with an empty list. Which is why we report this as an error.
@@ -326,14 +486,18 @@ class Task(QtCore.QObject):
             return
 
         with self._work_lock:
-            self._work.extend(work)
+            self._work.extend(items)
             self._work_count = max(self._work_count, len(self._work))
 
         if self._master is not None:
             if not self._attached:
                 self._master.add_task(self)
             else:
-                self._master.wake_workers()
+                count = len(items)
+                if self._threads > 0:
+                    count = min(count, self._threads)
+
+                self._master.wake_workers(count)
 
     def abort(self):
         if not self.can_abort:
@@ -343,7 +507,7 @@ class Task(QtCore.QObject):
         # Empty the work queue, this won't stop running workers but it will
         # stop calls to the work() method.
         with self._work_lock:
-            self._work = []
+            self._work.clear()
             self.aborted = True
 
         self._master.check_tasks()
@@ -416,7 +580,7 @@ class MultistepTask(Task):
                     return None
             else:
                 self._pending += 1
-                return (self, (self._work.pop(0),))
+                return (self, (self._work.popleft(),))
 
     def work(self, arg):
         if self.aborted:
@@ -888,9 +888,7 @@ class InstalledMod(Mod):
             with open(path, 'r') as stream:
                 data = json.load(stream)
 
-            mod = InstalledMod(None)
-            mod.folder = os.path.normpath(os.path.dirname(path))
-            mod.set(data)
+            mod = InstalledMod.from_data(os.path.dirname(path), data)
 
             user_path = os.path.join(os.path.dirname(path), 'user.json')
             if os.path.isfile(user_path):
@@ -904,6 +902,21 @@ class InstalledMod(Mod):
         else:
             return None
 
+    @staticmethod
+    def from_data(folder, data, user_data=None):
+        # data and user_data are the parsed contents of the mod's mod.json and user.json files.
+        mod = InstalledMod(None)
+        mod.folder = os.path.normpath(folder)
+        mod.set(data)
+
+        if user_data is not None:
+            try:
+                mod.set_user(user_data)
+            except Exception:
+                logging.exception('Failed to load user data for %s!' % mod)
+
+        return mod
+
     @staticmethod
     def convert(mod):
         data = mod.get()
@@ -1069,6 +1082,22 @@ class InstalledMod(Mod):
         with open(os.path.join(self.folder, 'user.json'), 'w', errors='replace') as stream:
             json.dump(self.get_user(), stream)
 
+    def has_manifest(self):
+        return os.path.isfile(os.path.join(self.folder, 'kn_manifest.json'))
+
+    def load_manifest(self):
+        """Returns a dict which maps filenames to the [size, mtime, inode, checksum] they had when they were last
+        verified."""
+        try:
+            with open(os.path.join(self.folder, 'kn_manifest.json'), 'r') as stream:
+                return json.load(stream)
+        except (OSError, ValueError):
+            return {}
+
+    def save_manifest(self, manifest):
+        with open(os.path.join(self.folder, 'kn_manifest.json'), 'w') as stream:
+            json.dump(manifest, stream)
+
     def update_mod_flag(self):
         old_list = self.mod_flag
         new_list = set([self.mid])
@@ -1128,6 +1157,12 @@ class InstalledMod(Mod):
 
         return paths, dev_involved
 
+    def get_vfs(self, pool=None):
+        from .vfs import ModVfs
+
+        paths, dev_involved = self.get_mod_flag()
+        return ModVfs(paths, pool)
+
     def get_executables(self, user=False):
         exes = []
         if user and self.user_custom_build:
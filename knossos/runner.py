@@ -335,7 +335,7 @@ def run_fs2_silent(params):
     return rc, output
 
 
-def run_mod(mod, tool=None, exe_label=None):
+def run_mod(mod, tool=None, exe_label=None, checked=False):
     global installed
 
     if mod is None:
@@ -351,6 +351,17 @@ def run_mod(mod, tool=None, exe_label=None):
             translate('runner', 'The mod "%s" could not be found!') % mod)
         return
 
+    if not checked and center.settings['check_before_launch']:
+        check_pkgs = get_launch_check_pkgs(inst_mod)
+        if check_pkgs:
+            # Make sure the files of the mod and its dependencies are intact first. The quick check only hashes files
+            # which changed since they were installed so this is cheap. The mod is launched once the check is done.
+            from . import tasks
+
+            tasks.run_task(tasks.CheckFilesTask(check_pkgs, inst_mod, quick=True,
+                on_continue=lambda: run_mod(mod, tool, exe_label, checked=True)))
+            return
+
     exes = []
 
     if tool:
@@ -444,6 +455,32 @@ def run_mod(mod, tool=None, exe_label=None):
         run_mod_ex(mod, sel_exe['file'], [path for path, label in mod_flag], bool(tool))
 
 
+def get_launch_check_pkgs(mod):
+    """Returns the installed packages which should be checked before mod is launched."""
+    pkgs = list(mod.packages)
+    try:
+        pkgs += mod.resolve_deps()
+    except Exception:
+        # run_mod() reports missing dependencies.
+        logging.debug('Failed to resolve the dependencies of %s for the launch check.', mod)
+
+    result = []
+    seen = set()
+    for pkg in pkgs:
+        pmod = pkg.get_mod()
+        if id(pkg) in seen or not isinstance(pmod, repo.InstalledMod):
+            continue
+
+        seen.add(id(pkg))
+
+        # Dev mode mods are changed all the time. Mods without a manifest (i.e. installed by an older version)
+        # would have to be hashed completely which takes too long before a launch.
+        if not pmod.dev_mode and pmod.has_manifest():
+            result.append(pkg)
+
+    return result
+
+
 def run_mod_ex(mod, binpath, mod_flag, is_tool):
     if not is_tool:
         mod.update_last_played()
@@ -300,6 +300,7 @@ def get_settings():
 
     kn_settings = center.settings.copy()
     del kn_settings['hash_cache']
+    del kn_settings['mirror_scores']
 
     fso['has_voice'] = sys.platform == 'win32'
 
@@ -672,12 +673,14 @@ def save_setting(name, value):
     if name not in center.settings:
         raise Exception('Trying to set invalid setting "%s"!' % name)
 
-    if name == 'max_downloads':
-        if value != center.settings['max_downloads']:
-            util.DL_POOL.set_capacity(value)
+    if name in ('max_downloads', 'download_autotune', 'download_slots_min', 'download_slots_max'):
+        if value != center.settings[name]:
+            center.settings[name] = value
+            util.configure_downloads()
     if name == 'download_bandwidth':
-        if value > 0.0:
-            util.SPEED_LIMIT_BUCKET.set_rate(value)
+        util.SPEED_LIMIT_BUCKET.set_rate(value)
+    elif name == 'background_bandwidth':
+        util.BACKGROUND_LIMIT.set_rate(value)
     elif name == 'language':
         # NOTE: This is deliberately not translated.
         QtWidgets.QMessageBox.information(None, 'Knossos', 'Please restart Knossos to complete the language change.')
@@ -25,13 +25,12 @@ import stat
 import json
 import tempfile
 import threading
-import random
 import time
 import re
 import hashlib
 import semantic_version
 
-from . import center, util, progress, nebula, repo, vplib, settings
+from . import center, util, progress, nebula, repo, vplib, settings, libindex
 from .repo import Repo
 from .qt import QtCore, QtWidgets, read_file
 
@@ -41,6 +40,7 @@ translate = QtCore.QCoreApplication.translate
 
 class FetchTask(progress.MultistepTask):
     background = True
+    resources = {'net', 'remote'}
     _public = None
     _private = None
     _steps = 2
@@ -90,8 +90,11 @@ class FetchTask(progress.MultistepTask):
                     with open(dest_path + '.etag', 'r') as hdl:
                         headers['If-None-Match'] = hdl.read()
 
+                # Try the repos which responded the fastest recently first.
+                repos = util.MIRRORS.rank(center.REPOS)
+
                 if self._check_only:
-                    for link in center.REPOS:
+                    for link in repos:
                         result = util.head(link, headers)
 
                         # if no change and list is already loaded then just bail
@@ -103,7 +106,7 @@ class FetchTask(progress.MultistepTask):
                             break
                 else:
                     with open(dest_path + '.tmp', 'wb') as dest:
-                        for link in center.REPOS:
+                        for link in repos:
                             result = util.download(link, dest, headers, get_etag=True)
 
                             if result == 304:
@@ -168,8 +171,19 @@ class FetchTask(progress.MultistepTask):
 
 class LoadLocalModsTask(progress.Task):
     background = True
+    resources = {'disk', 'installed', 'mod'}
     can_abort = False
 
+    # Mods are installed at most two levels below a library folder (see InstalledMod.generate_folder()). The extra
+    # level leaves some room for mods which were put there by hand.
+    max_depth = 3
+    # These folders never contain mods but can be huge.
+    skip_folders = {'data', 'temp', 'archive_cache', '__pycache__', '.git'}
+    _index = None
+    _known = None
+    _found = None
+    _parsed = None
+
     def __init__(self):
         super(LoadLocalModsTask, self).__init__(threads=3)
 
@@ -179,39 +193,123 @@ class LoadLocalModsTask(progress.Task):
         if center.settings['base_path'] is None:
             logging.warning('A LoadLocalModsTask was launched even though no base path was set!')
         else:
-            center.installed.clear()
-            self.add_work([center.settings['base_path']] + center.settings['base_dirs'])
+            # The installed mods repo is only modified once the scheduler lets us run. See _start_scan().
+            self.add_work([(None, 0)])
+
+    def _start_scan(self):
+        roots = [center.settings['base_path']] + center.settings['base_dirs']
+        self._found = set()
+        self._parsed = []
+        self._load_index(roots)
+
+        # Each library folder is scanned by its own worker.
+        self.add_work_many((path, 0) for path in roots)
+
+    def _load_index(self, roots):
+        self._index = libindex.LibraryIndex(os.path.join(center.settings['base_path'],
+                                                         center.get_library_json_name()))
+        self._index.load()
+        self._known = {}
+
+        # Add all mods which haven't changed since the last scan right away so the mod list can be displayed before
+        # the scan below is done. The scan will only have to parse new or modified mods.
+        installed = repo.InstalledRepo()
+        roots = tuple(os.path.join(os.path.normpath(path), '') for path in roots)
+        for folder in self._index.get_folders():
+            if not folder.startswith(roots):
+                continue
+
+            data = self._index.get(folder)
+            if data is None:
+                continue
+
+            try:
+                mod = repo.InstalledMod.from_data(folder, *data)
+                installed.add_mod(mod)
+            except Exception:
+                logging.exception('Failed to load "%s" from the library index!', folder)
+                continue
 
-    def work(self, path):
-        mods = center.installed
+            self._known[folder] = mod
+
+        # The main thread reads center.installed at any time (i.e. to display the mod list) so we replace it with the
+        # finished repo instead of modifying it. The mods found by the scan are added by finish() on the main thread.
+        center.installed = installed
+
+        if self._known:
+            # We're in a worker thread so the main thread has to update the UI.
+            center.signals.mod_list_changed.emit()
+
+    def work(self, item):
+        path, depth = item
+
+        if path is None:
+            self._start_scan()
+            return
 
         subs = []
         mod_file = None
 
         try:
-            for base in os.listdir(path):
-                sub = os.path.join(path, base)
-
-                if os.path.isdir(sub) and not sub.endswith('.dis'):
-                    subs.append(sub)
-                elif base.lower() == 'mod.json':
-                    mod_file = sub
+            with os.scandir(path) as it:
+                for entry in it:
+                    # is_dir() uses the information returned by scandir() and doesn't need an extra stat() call.
+                    if entry.is_dir():
+                        if not entry.name.endswith('.dis') and entry.name.lower() not in self.skip_folders:
+                            subs.append(entry.path)
+                    elif entry.name.lower() == 'mod.json':
+                        mod_file = entry.path
         except FileNotFoundError:
             logging.warning('The directory "%s" does not exist anymore!' % path)
         except PermissionError:
             logging.warning('Failed to scan "%s" during mod load because access was denied!' % path)
 
         if mod_file:
+            folder = os.path.normpath(path)
+            mod = self._known.get(folder)
+
             try:
-                mod = repo.InstalledMod.load(mod_file)
-                mods.add_mod(mod)
+                if mod is None:
+                    mod = repo.InstalledMod.from_data(folder, *self._index.read(folder))
+                    self._parsed.append(mod)
             except Exception:
-                logging.exception('Failed to parse "%s"!', sub)
+                logging.exception('Failed to parse "%s"!', mod_file)
+            else:
+                self._found.add(folder)
+
+                # There's no need to look at the mod's own files. However, mods can contain other mods
+                # (i.e. FS2/<mid>-<version>) so we still have to check the remaining folders.
+                owned = self._get_mod_folders(mod)
+                subs = [sub for sub in subs if os.path.basename(sub).lower() not in owned]
+
+        if subs and depth < self.max_depth:
+            self.add_work_many((sub, depth + 1) for sub in subs)
+
+    def _get_mod_folders(self, mod):
+        # Returns the lowercase names of the top level folders which contain the files of the given mod.
+        folders = set()
+        for pkg in mod.packages:
+            if mod.dev_mode:
+                folders.add(pkg.folder.replace('\\', '/').split('/')[0].lower())
+            else:
+                for item in pkg.filelist:
+                    folders.add(item['filename'].replace('\\', '/').split('/')[0].lower())
 
-        if subs:
-            self.add_work(subs)
+        return folders
 
     def finish(self):
+        if self._index is not None:
+            # Forget the mods which weren't found anymore and add the new ones.
+            for folder, mod in self._known.items():
+                if folder not in self._found:
+                    center.installed.del_mod(mod)
+
+            for mod in self._parsed:
+                center.installed.add_mod(mod)
+
+            self._index.prune(self._found)
+            self._index.save()
+
         center.main_win.update_mod_list()
 
 
@@ -222,12 +320,19 @@ class CheckFilesTask(progress.MultistepTask):
     _missing_image_mods = None
     _steps = 2
 
-    def __init__(self, pkgs, mod=None):
+    def __init__(self, pkgs, mod=None, quick=False, on_continue=None):
         super(CheckFilesTask, self).__init__()
 
         self.title = 'Checking %d packages...' % len(pkgs)
         self.pkgs = pkgs
         self._mod = mod
+        self.resources = {'disk'} | set('mod:' + pkg.get_mod().mid for pkg in pkgs)
+        # A quick check skips all files whose size, mtime and inode still match the mod's manifest (kn_manifest.json)
+        # which InstallTask writes. Files without a matching entry are checked against the hash cache.
+        self._quick = quick
+        # Called instead of showing a message if no problems were found. It's also called if the user doesn't want
+        # to repair the problems which were found.
+        self._on_continue = on_continue
         self._missing_image_mods = set()
 
         self.done.connect(self.finish)
@@ -255,21 +360,65 @@ class CheckFilesTask(progress.MultistepTask):
             'missing': []
         }
 
-        for info in pkg_files:
-            mypath = util.ipath(os.path.join(modpath, info['filename']))
-            if os.path.isfile(mypath):
+        # Dev mode mods are edited by their authors all the time so we don't keep a manifest for them.
+        mod = pkg.get_mod()
+        manifest = None if mod.dev_mode else mod.load_manifest()
+        manifest_changed = False
+
+        # Take the manifest entries before hashing. If a file changes in the meantime, its entry won't match next time.
+        paths = [util.ipath(os.path.join(modpath, info['filename'])) for info in pkg_files]
+        entries = {}
+        pending = []
+        for info, mypath in zip(pkg_files, paths):
+            entry = util.get_manifest_entry(mypath, info['checksum'])
+            if entry is None or not os.path.isfile(mypath):
+                continue
+
+            entries[mypath] = entry
+            if not (self._quick and manifest and manifest.get(info['filename']) == entry):
+                pending.append((info['checksum'], mypath))
+
+        # Queue all checks at once, util.HASH_POOL processes them in parallel.
+        results = dict(zip([mypath for _, mypath in pending], util.HASH_POOL.check_many(pending, self._quick)))
+
+        for info, mypath in zip(pkg_files, paths):
+            if mypath in entries:
                 progress.update(checked / count, 'Checking "%s"...' % (info['filename']))
 
-                if util.check_hash(info['checksum'], mypath, False):
+                result = results.get(mypath)
+                if result is None:
+                    # The file didn't change since it was last verified.
+                    valid = True
+                else:
+                    try:
+                        valid = result.result()
+                    except Exception:
+                        logging.exception('Failed to check "%s"!' % info['filename'])
+                        valid = False
+
+                if valid:
                     success += 1
                     summary['ok'].append(info['filename'])
+
+                    if manifest is not None and manifest.get(info['filename']) != entries[mypath]:
+                        manifest[info['filename']] = entries[mypath]
+                        manifest_changed = True
                 else:
                     summary['corrupt'].append(info['filename'])
+
+                    if manifest is not None and manifest.pop(info['filename'], None) is not None:
+                        manifest_changed = True
             else:
                 summary['missing'].append(info['filename'])
 
             checked += 1
 
+        if manifest_changed:
+            try:
+                mod.save_manifest(manifest)
+            except Exception:
+                logging.exception('Failed to save the file manifest for %s!' % mod)
+
         self.post((pkg, success, checked, summary))
 
     def init2(self):
@@ -292,6 +441,7 @@ class CheckFilesTask(progress.MultistepTask):
             # Ignore files are generated by Knossos. Only mod.json files that are in the location where we expect it to
             # be are ignored. All other mod.json files will be considered loose
             fnames.add(os.path.join(modpath, 'mod.json'))
+            fnames.add(os.path.join(modpath, 'kn_manifest.json'))
 
             for info in pkg.filelist:
                 # relative paths are valid here but we only want the filename
@@ -337,7 +487,11 @@ class CheckFilesTask(progress.MultistepTask):
         self._results = self._check_results
 
     def finish(self):
+        if self.aborted or self._check_results is None:
+            return
+
         bad_packages = []
+        repair = {}
         for result in self._check_results:
             if result[0] is None:
                 # This is the entry which contains the loose files
@@ -348,6 +502,10 @@ class CheckFilesTask(progress.MultistepTask):
                 # wrong with this package
                 bad_packages.append(result[0])
 
+                # Only these files have to be extracted again, the rest of the package is fine.
+                pkg = result[0]
+                repair[(pkg.get_mod().mid, pkg.name)] = set(result[3]['corrupt'] + result[3]['missing'])
+
         if len(bad_packages) > 0:
             msg = "An error was detected while validating the game file integrity. The following packages are invalid:"
             for pkg in bad_packages:
@@ -367,7 +525,11 @@ class CheckFilesTask(progress.MultistepTask):
 
             res = QtWidgets.QMessageBox.question(None, 'Knossos', msg)
             if res == QtWidgets.QMessageBox.Yes:
-                run_task(InstallTask(bad_packages, self._mod))
+                run_task(InstallTask(bad_packages, self._mod, repair=repair))
+            elif self._on_continue:
+                self._on_continue()
+        elif self._on_continue:
+            self._on_continue()
         else:
             QtWidgets.QMessageBox.information(None, 'Knossos', 'No problems were detected.')
 
@@ -379,15 +541,26 @@ class InstallTask(progress.MultistepTask):
     _pkgs = None
     _pkg_names = None
     _mods = None
+    _new_pkgs = None
     _editable = None
     _dls = None
-    _copies = None
-    _steps = 4
+    _mod_pending = None
+    _mod_lock = None
+    _steps = 1
     _error = False
-    _7z_lock = None
+    # Shared by all InstallTasks since the scheduler can run several of them at the same time.
+    _7z_lock = threading.Lock()
+    _repair = None
+    _abort_event = None
+    # The member names for a selective extraction are passed on 7z's command line. Windows limits that to 32K
+    # characters so we extract the whole archive if the names would take up more than this.
+    _selective_extract_chars = 16000
+    # Limits (in seconds) for the pause between two rounds of download attempts.
+    _retry_wait_max = 30
+    _retry_wait_total = 120
     check_after = True
 
-    def __init__(self, pkgs, mod=None, check_after=True, editable={}):
+    def __init__(self, pkgs, mod=None, check_after=True, editable={}, repair=None):
         super(InstallTask, self).__init__()
 
         self._mods = set()
@@ -395,39 +568,27 @@ class InstallTask(progress.MultistepTask):
         self._pkg_names = []
         self.check_after = check_after
         self._editable = editable
-
-        if sys.platform == 'win32':
-            self._7z_lock = threading.Lock()
+        # repair maps (mid, package name) to the filenames which CheckFilesTask found to be corrupt or missing. If it's
+        # set, all other files are assumed to be valid and aren't checked again.
+        self._repair = repair
+        self._abort_event = threading.Event()
 
         if mod is not None:
             self.mods = [mod]
 
+        # The packages are added to center.installed once the scheduler lets us run (see _add_pkgs()). Until then,
+        # a LoadLocalModsTask could still replace it.
+        self._new_pkgs = pkgs
         self._slot_prog = {}
-        for pkg in pkgs:
-            try:
-                pmod = center.installed.query(pkg.get_mod())
-                if pmod.dev_mode:
-                    # Don't modify mods which are in dev mode!
-                    continue
-            except repo.ModNotFound:
-                pass
-
-            ins_pkg = center.installed.add_pkg(pkg)
-            pmod = ins_pkg.get_mod()
-            self._pkgs.append(ins_pkg)
-            self._mods.add(pmod)
-            self._pkg_names.append((pmod.mid, ins_pkg.name))
 
-            for item in ins_pkg.files.values():
-                self._slot_prog[id(item)] = ('%s: %s' % (pmod.title, item['filename']), 0, 'Checking...')
-
-        center.main_win.update_mod_list()
         self.done.connect(self.finish)
         self.title = 'Installing mods...'
+        self.resources = {'net', 'disk', 'installed'} | set('mod:' + pkg.get_mod().mid for pkg in pkgs)
 
     def abort(self):
         super(InstallTask, self).abort()
 
+        self._abort_event.set()
         util.cancel_downloads()
 
     def finish(self):
@@ -437,17 +598,11 @@ class InstallTask(progress.MultistepTask):
             title = 'UNKNOWN'
 
         if self.aborted:
-            if self._cur_step == 1:
-                # Need to remove all those temporary directories.
-                for ar in self.get_results():
-                    try:
-                        shutil.rmtree(ar['tpath'])
-                    except Exception:
-                        logging.exception('Failed to remove "%s"!' % ar['tpath'])
-            else:
-                QtWidgets.QMessageBox.critical(None, 'Knossos',
-                    self.tr('The mod installation was aborted before it could finish. ' +
-                        'Uninstall the partially installed mod %s or verify the file integrity.' % title))
+            # Temporary directories clean up after themselves but archives which were already extracted (or files
+            # which were copied) stay where they are.
+            QtWidgets.QMessageBox.critical(None, 'Knossos',
+                self.tr('The mod installation was aborted before it could finish. ' +
+                    'Uninstall the partially installed mod %s or verify the file integrity.' % title))
         elif self._error:
             msg = self.tr(
                 'An error occured during the installation of %s. It might be partially installed.\n' % title +
@@ -458,23 +613,72 @@ class InstallTask(progress.MultistepTask):
         if not isinstance(self, UpdateTask) and self.check_after:
             run_task(LoadLocalModsTask())
 
+    def _add_pkgs(self):
+        for pkg in self._new_pkgs:
+            try:
+                pmod = center.installed.query(pkg.get_mod())
+                if pmod.dev_mode:
+                    # Don't modify mods which are in dev mode!
+                    continue
+            except repo.ModNotFound:
+                pass
+
+            ins_pkg = center.installed.add_pkg(pkg)
+            pmod = ins_pkg.get_mod()
+            self._pkgs.append(ins_pkg)
+            self._mods.add(pmod)
+            self._pkg_names.append((pmod.mid, ins_pkg.name))
+
+            for item in ins_pkg.files.values():
+                self._slot_prog[id(item)] = ('%s: %s' % (pmod.title, item['filename']), 0, 'Checking...')
+
+        # We're in a worker thread so the main thread has to update the UI.
+        center.signals.mod_list_changed.emit()
+
     def init1(self):
+        self._add_pkgs()
+
         if center.settings['neb_user']:
             for mod in self._mods:
                 if mod.mid in self._editable:
                     mod.dev_mode = True
 
-        self._threads = 3
-        self.add_work(self._mods)
+        # All stages run as work items of a single step: Once a mod has been checked, its downloads and copies are
+        # queued right away and its mod.json is written as soon as the last of them is done.
+        self._mod_pending = {}
+        self._mod_lock = threading.Lock()
+
+        for mod in self._mods:
+            self._mod_pending[mod] = 1
+
+        self._threads = 0
+        self.add_work([('check', mod, None) for mod in self._mods])
+
+    def work1(self, item):
+        kind, mod, data = item
+
+        try:
+            if kind == 'check':
+                self._check_mod(mod)
+            elif kind == 'download':
+                self._install_archive(data)
+            else:
+                self._copy_files(mod, data)
+        finally:
+            if kind == 'download' and '_pinned' in data:
+                # The archive was extracted (or failed), the archive cache may evict it now.
+                data['_pinned'].release(data['checksum'][1])
+
+            self._mod_step_done(mod)
 
-    def work1(self, mod):
+    def _check_mod(self, mod):
         modpath = mod.folder
         mfiles = mod.get_files()
         mnames = [f['filename'] for f in mfiles] + ['knossos.bmp', 'mod.json']
         self._local.slot = id(mod)
         self._slot_prog[id(mod)] = (mod.title, 0, '')
 
-        archives = set()
+        archives = {}
         progress.start_task(0, 0.9, '%s')
         progress.update(0, 'Checking %s...' % mod.title)
 
@@ -522,40 +726,78 @@ class InstallTask(progress.MultistepTask):
 
             inst_mods = []
 
-        for i, info in enumerate(mfiles):
+        # Check if we already have these files. The checksums are calculated in parallel by util.HASH_POOL.
+        missing = []
+        checks = []
+        for info in mfiles:
             if (mod.mid, info['package']) not in self._pkg_names:
                 continue
 
-            progress.update(i / amount, 'Checking %s: %s...' % (mod.title, info['filename']))
+            if self._repair is not None and info['filename'] not in self._repair.get((mod.mid, info['package']), ()):
+                continue
 
-            # Check if we already have this file
             if mod.dev_mode and mod in pkg_folders:
                 dest_path = util.ipath(os.path.join(mod.folder, pkg_folders[mod][info['package']], info['filename']))
             else:
                 dest_path = util.ipath(os.path.join(mod.folder, info['filename']))
 
-            found = os.path.isfile(dest_path) and util.check_hash(info['checksum'], dest_path)
+            if os.path.isfile(dest_path):
+                checks.append((info, dest_path))
+            else:
+                missing.append(info)
 
-            if not found:
-                for mv in inst_mods:
-                    if mv.dev_mode:
-                        try:
-                            itempath = util.ipath(os.path.join(mv.folder, pkg_folders[mv][info['package']], info['filename']))
-                        except KeyError:
-                            itempath = util.ipath(os.path.join(mv.folder, info['filename']))
-                    else:
+        results = util.HASH_POOL.check_many([(info['checksum'], dest_path) for info, dest_path in checks])
+        for i, ((info, dest_path), result) in enumerate(zip(checks, results)):
+            progress.update(i / amount, 'Checking %s: %s...' % (mod.title, info['filename']))
+
+            try:
+                valid = result.result()
+            except Exception:
+                logging.exception('Failed to check %s!' % dest_path)
+                valid = False
+
+            if not valid:
+                missing.append(info)
+
+        # Look for the missing files in the other installed versions of this mod.
+        for mv in inst_mods:
+            if not missing:
+                break
+
+            checks = []
+            for info in missing:
+                if mv.dev_mode:
+                    try:
+                        itempath = util.ipath(os.path.join(mv.folder, pkg_folders[mv][info['package']], info['filename']))
+                    except KeyError:
                         itempath = util.ipath(os.path.join(mv.folder, info['filename']))
+                else:
+                    itempath = util.ipath(os.path.join(mv.folder, info['filename']))
 
-                    if os.path.isfile(itempath) and util.check_hash(info['checksum'], itempath):
-                        copies.append((mod, info['package'], info['filename'], itempath))
-                        found = True
-                        break
+                if os.path.isfile(itempath):
+                    checks.append((info, itempath))
+
+            found = set()
+            results = util.HASH_POOL.check_many([(info['checksum'], itempath) for info, itempath in checks])
+            for (info, itempath), result in zip(checks, results):
+                try:
+                    valid = result.result()
+                except Exception:
+                    logging.exception('Failed to check %s!' % itempath)
+                    valid = False
 
-            if not found:
-                archives.add((mod.mid, info['package'], info['archive']))
-                logging.debug('%s: %s is missing/broken for %s.', info['package'], info['filename'], mod)
+                if valid:
+                    copies.append((mod, info['package'], info['filename'], itempath))
+                    found.add(id(info))
 
-        self.post((archives, copies))
+            missing = [info for info in missing if id(info) not in found]
+
+        for info in missing:
+            # Remember which files we need from each archive. The others are already in place.
+            archives.setdefault((mod.mid, info['package'], info['archive']), set()).add(info['filename'])
+            logging.debug('%s: %s is missing/broken for %s.', info['package'], info['filename'], mod)
+
+        self._schedule(mod, archives, copies)
         progress.finish_task()
         progress.start_task(0.9, 0, 'Downloading logos...')
 
@@ -594,39 +836,53 @@ class InstallTask(progress.MultistepTask):
         progress.finish_task()
         progress.update(1, 'Done preparing')
 
-    def init2(self):
-        archives = set()
-        copies = []
+    def _schedule(self, mod, archives, copies):
         downloads = []
 
-        for a, c in self.get_results():
-            archives |= a
-            copies.extend(c)
-
-        self._copies = copies
-
         for pkg in self._pkgs:
-            mod = pkg.get_mod()
+            if pkg.get_mod() is not mod:
+                continue
+
             for oitem in pkg.files.values():
                 if (mod.mid, pkg.name, oitem['filename']) in archives:
                     item = oitem.copy()
                     item['mod'] = mod
                     item['pkg'] = pkg
                     item['_id'] = id(oitem)
+                    item['_needed'] = archives[(mod.mid, pkg.name, oitem['filename'])]
                     downloads.append(item)
                 else:
-                    del self._slot_prog[id(oitem)]
+                    with self._progress_lock:
+                        self._slot_prog.pop(id(oitem), None)
 
         if len(archives) == 0:
-            logging.info('Nothing to do for this InstallTask!')
+            logging.info('Nothing to download for %s.', mod)
         elif len(downloads) == 0:
-            logging.error('Somehow we didn\'t find any downloads for this InstallTask!')
+            logging.error('Somehow we didn\'t find any downloads for %s!', mod)
             self._error = True
 
-        self._threads = 0
-        self.add_work(downloads)
+        work = [('download', mod, item) for item in downloads]
+        if copies:
+            with self._progress_lock:
+                self._slot_prog[('copies', id(mod))] = ('%s: Copy old files' % mod.title, 0, 'Waiting...')
+
+            work.append(('copy', mod, [info[1:] for info in copies]))
+
+        if work:
+            with self._mod_lock:
+                self._mod_pending[mod] += len(work)
 
-    def work2(self, archive):
+            self.add_work(work)
+
+    def _mod_step_done(self, mod):
+        with self._mod_lock:
+            self._mod_pending[mod] -= 1
+            finished = self._mod_pending[mod] == 0
+
+        if finished and not self.aborted:
+            self._finish_mod(mod)
+
+    def _install_archive(self, archive):
         self._local.slot = archive['_id']
 
         with tempfile.TemporaryDirectory() as tpath:
@@ -635,39 +891,104 @@ class InstallTask(progress.MultistepTask):
 
             retries = 10
             done = False
-            urls = list(archive['urls'])
-            random.shuffle(urls)
-            stream = open(arpath, 'wb')
+            urls = util.MIRRORS.rank(archive['urls'], archive.get('filesize'))
 
-            while retries > 0:
-                retries -= 1
+            algo, chksum = archive['checksum']
+            cache = util.get_archive_cache() if algo == 'sha256' else None
+            cached = cache.get(chksum, pin=True) if cache else None
 
-                for url in urls:
-                    progress.start_task(0, 0.97, '%s')
-                    progress.update(0, 'Ready')
+            if cached:
+                # Keep the archive in the cache until it's extracted (see work1()).
+                archive['_pinned'] = cache
 
-                    if not util.download(url, stream, continue_=True):
-                        if self.aborted:
-                            return
+                progress.update(0, 'Checking "%s"...' % archive['filename'])
 
-                        logging.error('Download of "%s" failed!', url)
-                        time.sleep(0.3)
-                        continue
+                if util.check_hash(archive['checksum'], cached):
+                    logging.info('Using the cached copy of "%s".', archive['filename'])
+                    arpath = cached
+                    done = True
+                    retries = 0
+                else:
+                    logging.warning('The cached copy of "%s" is corrupted!', archive['filename'])
+                    cache.remove(chksum)
+                    cache.release(chksum)
+                    del archive['_pinned']
+                    cached = None
+
+            if not done and archive.get('filesize', 0) >= util.SEGMENTED_THRESHOLD:
+                # Fetch large archives from all mirrors at once. If that fails, fall back to a single connection below.
+                progress.start_task(0, 0.97, '%s')
+                progress.update(0, 'Ready')
+                result = util.download_segmented(urls, arpath, archive['filesize'])
+                progress.finish_task()
 
-                    progress.finish_task()
-                    progress.update(0.97, 'Checking "%s"...' % archive['filename'])
+                if self.aborted:
+                    return
 
-                    stream.close()
+                if result:
+                    progress.update(0.97, 'Checking "%s"...' % archive['filename'])
 
-                    if util.check_hash(archive['checksum'], arpath):
+                    if util.hash_file(arpath, (algo,))[algo] == chksum:
                         done = True
                         retries = 0
-                        break
                     else:
-                        logging.error('File "%s" is corrupted!', url)
-                        stream = open(arpath, 'wb')
+                        logging.error('File "%s" is corrupted!', archive['filename'])
+
+            stream = None
+            waited = 0
+            if not done:
+                stream = open(arpath, 'w+b')
+                hasher = util.DownloadHash(archive['checksum'][0])
+
+            try:
+                while retries > 0:
+                    retries -= 1
+
+                    # Skip the mirrors which keep failing unless there's nothing else left.
+                    urls = util.MIRRORS.rank(urls, archive.get('filesize'))
+                    usable = [url for url in urls if not util.MIRRORS.is_blocked(url)] or urls[:1]
 
-                time.sleep(2)
+                    for url in usable:
+                        progress.start_task(0, 0.97, '%s')
+                        progress.update(0, 'Ready')
+
+                        if not util.download(url, stream, continue_=True, hasher=hasher):
+                            if self.aborted:
+                                return
+
+                            logging.error('Download of "%s" failed!', url)
+                            continue
+
+                        progress.finish_task()
+                        progress.update(0.97, 'Checking "%s"...' % archive['filename'])
+
+                        # The archive was hashed while it was downloaded so we don't have to read it again.
+                        hasher.catch_up(stream)
+                        stream.close()
+
+                        if hasher.hexdigest() == chksum:
+                            done = True
+                            retries = 0
+                            break
+                        else:
+                            logging.error('File "%s" is corrupted!', url)
+                            util.MIRRORS.record_failure(url)
+                            stream = open(arpath, 'w+b')
+                            hasher.reset()
+
+                    if not done and retries > 0:
+                        # Back off exponentially before the next round but don't wait forever for mirrors which keep
+                        # failing. Aborting the task interrupts the wait.
+                        delay = min(min(util.MIRRORS.get_backoff(url) for url in urls), self._retry_wait_max)
+                        if waited + delay > self._retry_wait_total:
+                            break
+
+                        waited += delay
+                        if self._abort_event.wait(delay):
+                            return
+            finally:
+                if stream:
+                    stream.close()
 
             if not done:
                 logging.error('Missing file "%s"!', archive['filename'])
@@ -677,11 +998,34 @@ class InstallTask(progress.MultistepTask):
             if self.aborted:
                 return
 
+            if cache and not cached:
+                try:
+                    stored = cache.add(arpath, chksum, move=True, pin=True)
+                    if stored:
+                        archive['_pinned'] = cache
+                        arpath = stored
+                except Exception:
+                    logging.exception('Failed to store "%s" in the archive cache!', archive['filename'])
+
+            dev_mode = archive['pkg'].get_mod().dev_mode
+            if util.can_stream_extract(archive['filename']) and not (dev_mode and archive['pkg'].is_vp):
+                self._stream_archive(archive, arpath, dev_mode)
+                return
+
             cpath = os.path.join(tpath, 'content')
             os.mkdir(cpath)
 
-            needed_files = filter(lambda item: item['archive'] == archive['filename'], archive['pkg'].filelist)
-            done = False
+            needed_files = self._get_needed_files(archive)
+
+            # Only extract the files we actually need. This is a lot faster if we're just repairing a few files from a
+            # large archive. If 7z doesn't find them (i.e. due to case differences), we extract everything.
+            all_files = [item for item in archive['pkg'].filelist if item['archive'] == archive['filename']]
+            names = [item['orig_name'] for item in needed_files]
+            if len(needed_files) < len(all_files) and not (dev_mode and archive['pkg'].is_vp) and \
+                    sum(len(name) + 3 for name in names) <= self._selective_extract_chars:
+                attempts = (names, None)
+            else:
+                attempts = (None,)
 
             if sys.platform == 'win32':
                 # Apparently I can't run multiple 7z instances on Windows. If I do, I always get the error
@@ -690,26 +1034,10 @@ class InstallTask(progress.MultistepTask):
                 # TODO: Is there a better solution?
 
                 progress.update(0.98, 'Waiting...')
-                self._7z_lock.acquire()
-
-            progress.update(0.98, 'Extracting...')
-            logging.debug('Extracting %s into %s', archive['filename'], modpath)
-
-            if util.extract_archive(arpath, cpath):
-                done = True
-                # Look for missing files
-                for item in needed_files:
-                    src_path = util.ipath(os.path.join(cpath, item['orig_name']))
-
-                    if not os.path.isfile(src_path):
-                        logging.warning('Missing file "%s" from archive "%s" for package "%s" (%s)!',
-                                        item['orig_name'], archive['filename'], archive['pkg'].name, archive['mod'].title)
-
-                        done = False
-                        break
-
-            if sys.platform == 'win32':
-                self._7z_lock.release()
+                with self._7z_lock:
+                    done = self._extract_archive(archive, arpath, cpath, attempts, needed_files)
+            else:
+                done = self._extract_archive(archive, arpath, cpath, attempts, needed_files)
 
             if not done:
                 logging.error('Failed to unpack archive "%s" for package "%s" (%s)!',
@@ -718,12 +1046,7 @@ class InstallTask(progress.MultistepTask):
                 self._error = True
                 return
 
-            dev_mode = archive['pkg'].get_mod().dev_mode
-
-            for item in archive['pkg'].filelist:
-                if item['archive'] != archive['filename']:
-                    continue
-
+            for item in needed_files:
                 src_path = util.ipath(os.path.join(cpath, item['orig_name']))
                 if dev_mode:
                     dest_path = util.ipath(os.path.join(modpath, archive['pkg'].folder, item['filename']))
@@ -759,6 +1082,10 @@ class InstallTask(progress.MultistepTask):
                                     raise
                                 else:
                                     time.sleep(1)
+
+                        # The archive passed its checksum test so we can trust the checksums in the file list.
+                        # This saves CheckFilesTask and UpdateTask from hashing these files again.
+                        util.seed_hash(item['checksum'], dest_path)
                 except Exception:
                     logging.exception('Failed to move file "%s" from archive "%s" for package "%s" (%s) to its destination %s!',
                                       src_path, archive['filename'], archive['pkg'].name, archive['mod'].title, dest_path)
@@ -790,28 +1117,88 @@ class InstallTask(progress.MultistepTask):
 
             progress.update(1, 'Done.')
 
-    def init3(self):
-        self.add_work((None,))
+    def _extract_archive(self, archive, arpath, cpath, attempts, needed_files):
+        """Extracts arpath into cpath with 7z. Returns True if all needed_files were extracted.
 
-    def work3(self, _):
-        self._slot_prog['copies'] = ('Copy old files', 0, 'Waiting...')
-        self._local.slot = 'copies'
+        attempts is a sequence of member lists (or None for the whole archive) which are tried in order.
+        """
+        progress.update(0.98, 'Extracting...')
+        logging.debug('Extracting %s into %s', archive['filename'], archive['mod'].folder)
 
-        pkg_folders = {}
+        for files in attempts:
+            if files is None and len(attempts) > 1:
+                logging.debug('Extracting all of %s instead.', archive['filename'])
+                shutil.rmtree(cpath, ignore_errors=True)
+                os.mkdir(cpath)
+
+            # Cached archives are named after their checksum so the format has to be determined by the original name.
+            if not util.extract_archive(arpath, cpath, files=files, name=archive['filename']):
+                continue
+
+            # Look for missing files
+            for item in needed_files:
+                src_path = util.ipath(os.path.join(cpath, item['orig_name']))
+
+                if not os.path.isfile(src_path):
+                    logging.warning('Missing file "%s" from archive "%s" for package "%s" (%s)!',
+                                    item['orig_name'], archive['filename'], archive['pkg'].name,
+                                    archive['mod'].title)
+                    break
+            else:
+                return True
+
+        return False
+
+    def _stream_archive(self, archive, arpath, dev_mode):
+        # zip and tar archives are extracted in-process. Each file is written (and verified) directly at its final
+        # location so we don't need a temporary directory.
+        modpath = archive['mod'].folder
+        targets = {}
 
-        count = float(len(self._copies))
+        for item in self._get_needed_files(archive):
+            if dev_mode:
+                dest_path = util.ipath(os.path.join(modpath, archive['pkg'].folder, item['filename']))
+            else:
+                dest_path = util.ipath(os.path.join(modpath, item['filename']))
+
+            targets[item['orig_name']] = (dest_path, item['checksum'])
+
+        progress.start_task(0.98, 0.02, '%s')
         try:
-            for i, info in enumerate(self._copies):
-                mod, pkg_name, fn, src = info
+            failed = util.stream_extract(arpath, targets, os.path.join(modpath, archive.get('dest', '')))
+        except Exception:
+            logging.exception('Failed to extract "%s"!' % archive['filename'])
+            failed = True
 
+        progress.finish_task()
+
+        if failed:
+            logging.error('Failed to unpack archive "%s" for package "%s" (%s)!',
+                          archive['filename'], archive['pkg'].name, archive['mod'].title)
+            self._error = True
+        else:
+            progress.update(1, 'Done.')
+
+    def _get_needed_files(self, archive):
+        # Returns the file list entries which have to be extracted from this archive.
+        needed = archive.get('_needed')
+        return [item for item in archive['pkg'].filelist
+                if item['archive'] == archive['filename'] and (needed is None or item['filename'] in needed)]
+
+    def _copy_files(self, mod, copies):
+        self._local.slot = ('copies', id(mod))
+
+        pkg_folders = {}
+        if mod.dev_mode:
+            for pkg in mod.packages:
+                pkg_folders[pkg.name] = pkg.folder
+
+        count = float(len(copies))
+        try:
+            for i, (pkg_name, fn, src) in enumerate(copies):
                 progress.update(i / count, fn)
                 if mod.dev_mode:
-                    if mod not in pkg_folders:
-                        pkg_folders[mod] = {}
-                        for pkg in mod.packages:
-                            pkg_folders[mod][pkg.name] = pkg.folder
-
-                    dest = os.path.join(mod.folder, pkg_folders[mod][pkg_name], fn)
+                    dest = os.path.join(mod.folder, pkg_folders[pkg_name], fn)
                 else:
                     dest = os.path.join(mod.folder, fn)
 
@@ -829,30 +1216,41 @@ class InstallTask(progress.MultistepTask):
         else:
             progress.update(1, 'Done')
 
-    def init4(self):
-        self.add_work((None,))
-
-    def work4(self, _):
-        first = True
+    def _finish_mod(self, mod):
+        # Generate the mod.json file.
+        try:
+            mod.save()
+        except Exception:
+            logging.exception('Failed to generate mod.json file for %s!' % mod.mid)
 
-        # Generate mod.json files.
-        for mod in self._mods:
+        # Remember how the installed files look like so a quick CheckFilesTask doesn't have to hash them again.
+        if not self._error and not mod.dev_mode:
             try:
-                mod.save()
-            except Exception:
-                logging.exception('Failed to generate mod.json file for %s!' % mod.mid)
+                manifest = mod.load_manifest()
+                for info in mod.get_files():
+                    if (mod.mid, info['package']) not in self._pkg_names:
+                        continue
 
-            try:
-                util.post(center.API + 'track', data={
-                    'counter': 'install_mod',
-                    'mid': mod.mid,
-                    'version': str(mod.version),
-                    'dependency': 'false' if first else 'true'
-                })
+                    entry = util.get_manifest_entry(util.ipath(os.path.join(mod.folder, info['filename'])),
+                        info['checksum'])
+                    if entry is None:
+                        manifest.pop(info['filename'], None)
+                    else:
+                        manifest[info['filename']] = entry
+
+                mod.save_manifest(manifest)
             except Exception:
-                pass
+                logging.exception('Failed to save the file manifest for %s!' % mod)
 
-            first = False
+        try:
+            util.post(center.API + 'track', data={
+                'counter': 'install_mod',
+                'mid': mod.mid,
+                'version': str(mod.version),
+                'dependency': 'false' if not self.mods or self.mods[0].mid == mod.mid else 'true'
+            })
+        except Exception:
+            pass
 
 
 # TODO: make sure all paths are relative (no mod should be able to install to C:\evil)
@@ -883,6 +1281,8 @@ class UninstallTask(progress.MultistepTask):
 
         self.done.connect(self.finish)
         self.title = 'Uninstalling mods...'
+        self.resources = {'disk', 'installed'} | set('mod:' + item.get_mod().mid for item in self._pkgs) | \
+            set('mod:' + mod.mid for mod in self._mods)
 
     def init1(self):
         self.add_work(self._pkgs)
@@ -916,7 +1316,8 @@ class UninstallTask(progress.MultistepTask):
             elif len(mod.packages) == 0:
                 # Remove our files
 
-                my_files = [os.path.join(modpath, 'mod.json'), mod.logo, mod.tile, mod.banner]
+                my_files = [os.path.join(modpath, 'mod.json'), os.path.join(modpath, 'kn_manifest.json'), mod.logo,
+                    mod.tile, mod.banner]
                 my_files += mod.screenshots + mod.attachments
                 for path in my_files:
                     if path and os.path.isfile(path):
@@ -1034,26 +1435,26 @@ class UpdateTask(InstallTask):
         self._old_mod = mod
         super(UpdateTask, self).__init__(pkgs, self._new_mod, check_after=False, editable=editable)
 
-    def work4(self, _):
-        super(UpdateTask, self).work4(_)
+    def _add_pkgs(self):
+        super(UpdateTask, self)._add_pkgs()
 
         # We can't use _new_mod here since it's a Mod but we need an InstalledMod here.
-        new_mod = None
-        for mod in self._mods:
-            if mod.mid == self._old_mod.mid:
-                new_mod = mod
-                break
+        if not any(mod.mid == self._old_mod.mid for mod in self._mods):
+            logging.error('Failed to find new modpath during update of %s!' % self._old_mod)
 
-        if new_mod:
-            fso_path = settings.get_fso_profile_path()
-            old_settings = os.path.join(fso_path, os.path.basename(self._old_mod.folder))
-            new_settings = os.path.join(fso_path, os.path.basename(new_mod.folder))
+    def _finish_mod(self, new_mod):
+        super(UpdateTask, self)._finish_mod(new_mod)
 
-            # If we have generated files for the old mod copy them over to the new one (i.e. checkpoints and other script generated stuff).
-            if os.path.isdir(old_settings) and not os.path.isdir(new_settings):
-                shutil.copytree(old_settings, new_settings)
-        else:
-            logging.error('Failed to find new modpath during update of %s!' % self._old_mod)
+        if new_mod.mid != self._old_mod.mid:
+            return
+
+        fso_path = settings.get_fso_profile_path()
+        old_settings = os.path.join(fso_path, os.path.basename(self._old_mod.folder))
+        new_settings = os.path.join(fso_path, os.path.basename(new_mod.folder))
+
+        # If we have generated files for the old mod copy them over to the new one (i.e. checkpoints and other script generated stuff).
+        if os.path.isdir(old_settings) and not os.path.isdir(new_settings):
+            shutil.copytree(old_settings, new_settings)
 
     def finish(self):
         super(UpdateTask, self).finish()
@@ -1333,7 +1734,15 @@ class UploadTask(progress.MultistepTask):
 
                     for sub, dirs, files in os.walk(pkg_path):
                         relsub = os.path.relpath(sub, pkg_path)
+                        if relsub == '.':
+                            # Skip the cached VPs and files.json of previous uploads (see _pack_vp()).
+                            dirs[:] = [d for d in dirs if not d.startswith('kn_upload-')]
+
                         for fn in files:
+                            if relsub == '.' and fn.startswith('kn_upload-'):
+                                # Leftovers from previous uploads if the package lives in the mod's root folder
+                                continue
+
                             if pkg.is_vp and fn.lower().endswith('.vp'):
                                 self._reason = 'vp inception'
                                 self.abort()
@@ -1384,12 +1793,13 @@ class UploadTask(progress.MultistepTask):
                 done = 0
                 for pkg in self._mod.packages:
                     pkg_path = os.path.join(self._mod.folder, pkg.folder)
+                    results = util.HASH_POOL.submit_many([os.path.join(pkg_path, fn['filename']) for fn in pkg.filelist])
 
-                    for fn in pkg.filelist:
+                    for fn, result in zip(pkg.filelist, results):
                         progress.update(done / fc, fn['filename'])
 
                         try:
-                            fn['checksum'] = util.gen_hash(os.path.join(pkg_path, fn['filename']))
+                            fn['checksum'] = result.result()
                         except Exception:
                             logging.exception('Failed to generate checksum for file %s in package %s!' % (fn['filename'], pkg.name))
 
@@ -1495,26 +1905,18 @@ class UploadTask(progress.MultistepTask):
                 progress.update(0, 'Packing...')
                 if pkg.is_vp:
                     vp_name = os.path.basename(pkg.folder) + '.vp'
-                    vp_path = os.path.join(self._dir.name, vp_name)
-                    vp = vplib.VpWriter(vp_path)
-                    pkg_path = os.path.join(self._mod.folder, pkg.folder)
-
-                    for item in pkg.filelist:
-                        vp.add_file(item['filename'], os.path.join(pkg_path, item['filename']))
 
                     progress.start_task(0.0, 0.1, '%s')
                     try:
-                        vp.write()
+                        vp_checksum = self._pack_vp(pkg, store_name, vp_name)
                     except vplib.EmptyFileException as exc:
                         self._reason = 'empty file in vp'
                         self._msg = exc.file
                         self.abort()
                         return
 
-                    progress.update(1, 'Calculating checksum...')
                     progress.finish_task()
 
-                    vp_checksum = util.gen_hash(vp_path)
                     pkg.filelist = [{
                         'filename': vp_name,
                         'archive': ar_name,
@@ -1536,7 +1938,7 @@ class UploadTask(progress.MultistepTask):
                 _7z_msg = ''
                 if pkg.is_vp:
                     p = util.Popen([util.SEVEN_PATH, 'a', '-bsp1', ar_path, vp_name],
-                        cwd=self._dir.name, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                        cwd=store_name, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
                 else:
                     p = util.Popen([util.SEVEN_PATH, 'a', '-bsp1', ar_path, '.'],
                         cwd=os.path.join(self._mod.folder, pkg.folder), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
@@ -1616,6 +2018,59 @@ class UploadTask(progress.MultistepTask):
             self._reason = 'unknown'
             self.abort()
 
+    def _pack_vp(self, pkg, vp_dir, vp_name):
+        # The VP from the last upload is kept in vp_dir. If we have it, we only append new and changed files to it.
+        vp_path = os.path.join(vp_dir, vp_name)
+        meta_path = os.path.join(vp_dir, 'files.json')
+        pkg_path = os.path.join(self._mod.folder, pkg.folder)
+        old_files = None
+
+        if os.path.isfile(meta_path):
+            if os.path.isfile(vp_path):
+                try:
+                    with open(meta_path, 'r') as stream:
+                        old_files = json.load(stream)
+                except Exception:
+                    logging.exception('Failed to parse metadata for packed VP %s!' % vp_path)
+
+            # The VP is about to change. Make sure we don't trust it next time if something goes wrong.
+            util.safe_unlink(meta_path)
+        elif not os.path.isdir(vp_dir):
+            os.makedirs(vp_dir)
+
+        vp = None
+        if old_files:
+            try:
+                vp = vplib.VpUpdater(vp_path)
+            except Exception:
+                logging.exception('Failed to open packed VP %s! Rebuilding it...' % vp_path)
+            else:
+                for item in pkg.filelist:
+                    if old_files.get(item['filename']) == list(item['checksum']) and vp.keep_file(item['filename']):
+                        continue
+
+                    vp.add_file(item['filename'], os.path.join(pkg_path, item['filename']))
+
+                if vp.needs_compaction():
+                    logging.info('Rebuilding %s since too much of it is unused.' % vp_path)
+                    vp = None
+
+        if vp is None:
+            for item in os.listdir(vp_dir):
+                if item.lower().endswith('.vp'):
+                    util.safe_unlink(os.path.join(vp_dir, item))
+
+            vp = vplib.VpWriter(vp_path)
+            for item in pkg.filelist:
+                vp.add_file(item['filename'], os.path.join(pkg_path, item['filename']))
+
+        vp_checksum, _ = vp.write()
+
+        with open(meta_path, 'w') as stream:
+            json.dump({item['filename']: item['checksum'] for item in pkg.filelist}, stream)
+
+        return vp_checksum
+
     def init2(self):
         self._local.slot = 'total'
 
@@ -1647,7 +2102,8 @@ class UploadTask(progress.MultistepTask):
         try:
             if self._success:
                 for item in os.listdir(self._mod.folder):
-                    if item.startswith('kn_upload-'):
+                    # Keep the packed VPs (folders) around, the next upload will only append the changes to them.
+                    if item.startswith('kn_upload-') and not os.path.isdir(os.path.join(self._mod.folder, item)):
                         logging.debug('Removing %s...' % item)
 
                         util.safe_unlink(os.path.join(self._mod.folder, item))
@@ -2014,6 +2470,7 @@ class GOGCopyTask(progress.Task):
 
 class CheckUpdateTask(progress.Task):
     background = True
+    resources = {'net'}
 
     def __init__(self):
         super(CheckUpdateTask, self).__init__()
@@ -2177,7 +2634,8 @@ class VpExtractionTask(progress.Task):
 
         self.title = 'Extracting VP files...'
 
-        self._threads = 1  # VP extraction does not benefit from multiple threads
+        # util.extract_vp_file() already uses a thread pool for each VP.
+        self._threads = 1
 
         for vp_file in os.listdir(ini_mod.folder):
             # We only look at vp files
@@ -2333,7 +2791,10 @@ class FixImagesTask(progress.Task):
 
         self.title = 'Fixing mod images...'
         self.done.connect(self.finish)
-        self.add_work(center.installed.get_list())
+
+        mods = center.installed.get_list()
+        self.resources = {'net', 'installed:read'} | set('mod:' + mod.mid for mod in mods if mod.dev_mode == do_devs)
+        self.add_work(mods)
 
     def work(self, mod):
         if mod.dev_mode != self._do_devs:
@@ -2398,7 +2859,7 @@ class FixImagesTask(progress.Task):
                         dest = os.path.join(mod.folder, 'kn_' + prop + ext)
 
                         progress.start_task(done / count, 1 / count, '%s')
-                        if util.safe_download(r_path, dest):
+                        if util.safe_download(r_path, dest, util.BACKGROUND_LIMIT):
                             setattr(mod, prop, dest)
                             self._fixed += 1
                         else:
@@ -2436,7 +2897,7 @@ class FixImagesTask(progress.Task):
                         dest = os.path.join(mod.folder, 'kn_' + prop + '_' + str(i) + ext)
 
                         progress.start_task(done / count, 1 / count, '%s')
-                        if util.safe_download(r_paths[i], dest):
+                        if util.safe_download(r_paths[i], dest, util.BACKGROUND_LIMIT):
                             im_paths[i] = dest
                             self._fixed += 1
                         else:
@@ -26,13 +26,19 @@ import random
 import functools
 import glob
 import shutil
+import mmap
+import tarfile
+import zipfile
+import concurrent.futures
 import semantic_version
 import requests
-import token_bucket
-from threading import Condition, Event, Lock
+from six.moves.urllib import parse as urlparse
+from threading import Condition, Event, Lock, local
 from collections import deque
 
 from .vplib import VpReader
+from .hashcache import HashCache
+from .archivecache import ArchiveCache
 from . import center, progress
 from .qt import QtCore
 
@@ -98,43 +104,91 @@ HTTP_SESSION = requests.Session()
 HTTP_SESSION.verify = True
 QUIET = not center.DEBUG
 QUIET_EXC = False
-HASH_CACHE = dict()
-HASH_LOCK = Lock()
+HASH_CACHE = HashCache()
+ARCHIVE_CACHE = None
+HASH_POOL = None
+HASH_BUFSIZE = 1024 * 1024  # 1 MiB
+HASH_MMAP_THRESHOLD = 64 * 1024 * 1024  # 64 MiB
+_HASH_BUFFERS = local()
+_HASH_PATH_LOCKS = dict()
+_HASH_PATH_LOCKS_LOCK = Lock()
 _HAS_TAR = None
 DL_POOL = None
+DL_TUNER = None
+MIRRORS = None
 _DL_CANCEL = Event()
+SEGMENT_SIZE = 16 * 1024 * 1024  # 16 MiB
+SEGMENTED_THRESHOLD = 64 * 1024 * 1024  # 64 MiB
 _DL_CANCEL.clear()
 SPEED_LIMIT_BUCKET = None
+BACKGROUND_LIMIT = None
 translate = QtCore.QCoreApplication.translate
 
 
-class BlockingTokenBucket(object):
-    def __init__(self, rate):
-        self.limiter = None
-        self.rate = None
+class RateLimiter(object):
+    """A token bucket which limits the bandwidth of all downloads using it.
 
-        self.set_rate(rate)
+    Callers reserve their tokens up front (the bucket can go into debt) and sleep until their reservation is covered.
+    Reservations are served in the order they were made so concurrent downloads share the bandwidth fairly. A limiter
+    with a parent also has to wait for the parent's bucket which allows sub-limits (i.e. for background downloads).
+    A rate <= 0 disables the limit.
+    """
 
-    def set_rate(self, rate):
-        self.limiter = token_bucket.Limiter(rate, rate, token_bucket.MemoryStorage())
+    def __init__(self, rate, parent=None):
+        self.parent = parent
         self.rate = rate
+        self._lock = Lock()
+        self._tokens = max(rate, 0)
+        self._last = time.monotonic()
 
-    def wait_for_consume(self, tokens, cancel_event):
-        while tokens > 0:
-            # If the number of tokens is more than what is available in the bucket then we would never be able to
-            # consume the tokens. This will retrieve the tokens in smaller steps if the number of requested tokens
-            # is larger than the available token rate
-            consuming = min(tokens, self.rate)
-
-            # Busy waiting is not optimal but our token bucket does not support anything else
-            while not self.limiter.consume(b"default", consuming):
-                if cancel_event.is_set():
-                    return False
-                time.sleep(0.01)
+    def _refill(self, now):
+        if self.rate > 0:
+            self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
 
-            tokens -= consuming
+        self._last = now
 
-        return True
+    def set_rate(self, rate):
+        # Keep the current state (and debt) so the change doesn't give anyone a free burst.
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+            self._tokens = min(self._tokens, rate) if rate > 0 else 0
+
+    def get_rate(self):
+        """Returns the effective rate (including our parents) or -1 if there's no limit."""
+        rates = []
+        limiter = self
+        while limiter:
+            if limiter.rate > 0:
+                rates.append(limiter.rate)
+
+            limiter = limiter.parent
+
+        return min(rates) if rates else -1
+
+    def _reserve(self, tokens, now):
+        with self._lock:
+            self._refill(now)
+
+            if self.rate > 0:
+                self._tokens -= tokens
+                delay = max(0, -self._tokens / self.rate)
+            else:
+                delay = 0
+
+        if self.parent:
+            delay = max(delay, self.parent._reserve(tokens, now))
+
+        return delay
+
+    def wait_for_consume(self, tokens, cancel_event):
+        """Blocks until we're allowed to transfer tokens bytes. Returns False if cancel_event was set in the meantime."""
+        delay = self._reserve(tokens, time.monotonic())
+
+        if delay > 0:
+            return not cancel_event.wait(delay)
+        else:
+            return not cancel_event.is_set()
 
 
 class ResizableSemaphore(object):
@@ -231,6 +285,258 @@ class SpeedCalc(object):
         return max(sum(self.speeds) / len(self.speeds), 0.1)
 
 
+class DownloadHash(object):
+    """Hashes a download while it's being written.
+
+    pos tracks how many bytes of the destination have been hashed. If a download is resumed, only the part that isn't
+    covered yet is read back from the file (which has to be opened in a readable mode for that).
+    """
+
+    def __init__(self, algo='sha256'):
+        self.algo = algo
+        self.reset()
+
+    def reset(self):
+        self._hash = hashlib.new(self.algo)
+        self.pos = 0
+
+    def update(self, chunk):
+        self._hash.update(chunk)
+        self.pos += len(chunk)
+
+    def catch_up(self, stream):
+        """Makes sure the digest covers everything in stream up to the current position."""
+        end = stream.tell()
+        if end == self.pos:
+            return
+
+        if end < self.pos:
+            self.reset()
+
+        buf = _get_hash_buffer()
+        view = memoryview(buf)
+
+        stream.seek(self.pos)
+        while self.pos < end:
+            count = stream.readinto(view[:min(len(buf), end - self.pos)])
+            if not count:
+                break
+
+            self.update(view[:count])
+
+        view.release()
+        stream.seek(end)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+class MirrorScoreboard(object):
+    """Keeps track of how well each download host performed.
+
+    For every host we remember an exponential moving average of the throughput, the time to first byte and the failure
+    rate. Hosts which failed several times in a row are put on hold with an exponential backoff. Hosts which ignore
+    range requests are remembered separately since they still work fine for regular downloads.
+    The scores are stored in settings.json (see load() and dump()).
+    """
+    weight = 0.3
+    max_backoff = 120
+    default_speed = 1024 * 1024  # 1 MB/s, optimistic enough that unknown mirrors get a chance.
+
+    def __init__(self):
+        self._hosts = {}
+        self._lock = Lock()
+
+    def _get_host(self, url):
+        host = urlparse.urlsplit(url).netloc.lower()
+        info = self._hosts.get(host)
+        if info is None:
+            info = self._hosts[host] = self._new_info()
+
+        return info
+
+    def _new_info(self):
+        return {
+            'speed': None,
+            'ttfb': None,
+            'fail_rate': 0.0,
+            'fails': 0,
+            'blocked_until': 0,
+            'no_range': False
+        }
+
+    def _avg(self, old, value):
+        if old is None:
+            return value
+
+        return old + self.weight * (value - old)
+
+    def load(self, data):
+        hosts = {}
+        for host, info in (data or {}).items():
+            entry = self._new_info()
+            entry.update(info)
+
+            # Failures from an earlier session shouldn't keep a host on hold and the host might have added range
+            # support in the meantime. Only the averages are kept.
+            entry['fails'] = 0
+            entry['blocked_until'] = 0
+            entry['no_range'] = False
+            hosts[host] = entry
+
+        with self._lock:
+            self._hosts = hosts
+
+    def dump(self):
+        with self._lock:
+            return dict((host, info.copy()) for host, info in self._hosts.items())
+
+    def record_success(self, url, ttfb, size=0, duration=0):
+        with self._lock:
+            info = self._get_host(url)
+            info['ttfb'] = self._avg(info['ttfb'], ttfb)
+            info['fail_rate'] = self._avg(info['fail_rate'], 0.0)
+            info['fails'] = 0
+            info['blocked_until'] = 0
+
+            # Tiny transfers say more about the latency than the throughput.
+            if size >= 256 * 1024 and duration > 0:
+                info['speed'] = self._avg(info['speed'], size / duration)
+
+    def record_failure(self, url):
+        with self._lock:
+            info = self._get_host(url)
+            info['fail_rate'] = self._avg(info['fail_rate'], 1.0)
+            info['fails'] += 1
+
+            if info['fails'] >= 2:
+                info['blocked_until'] = time.time() + self._get_backoff(info)
+
+    def record_no_range(self, url):
+        """Remembers that this host ignores range requests. This doesn't count as a failure."""
+        with self._lock:
+            self._get_host(url)['no_range'] = True
+
+    def supports_range(self, url):
+        with self._lock:
+            return not self._get_host(url)['no_range']
+
+    def _get_backoff(self, info):
+        return min(0.5 * 2 ** info['fails'], self.max_backoff)
+
+    def get_backoff(self, url):
+        """Returns how long we should wait before trying this host again."""
+        with self._lock:
+            return self._get_backoff(self._get_host(url))
+
+    def is_blocked(self, url):
+        with self._lock:
+            return self._get_host(url)['blocked_until'] > time.time()
+
+    def rank(self, urls, size=None):
+        """Sorts urls by the expected time it takes to download size bytes. Blocked hosts come last."""
+        if size is None:
+            size = 16 * 1024 * 1024
+
+        now = time.time()
+        scores = {}
+
+        with self._lock:
+            for url in urls:
+                info = self._get_host(url)
+                expected = (info['ttfb'] or 0) + size / (info['speed'] or self.default_speed)
+
+                # A mirror which fails half of the time needs (on average) two attempts.
+                expected /= max(1.0 - info['fail_rate'], 0.05)
+                scores[url] = (info['blocked_until'] > now, expected, random.random())
+
+        return sorted(urls, key=scores.get)
+
+
+class DownloadTuner(object):
+    """Adjusts the capacity of a ResizableSemaphore (DL_POOL) based on the aggregate download throughput.
+
+    Every window seconds, one slot is added if all slots are busy and the throughput went up since the last check.
+    The number of slots is halved if downloads failed or the throughput dropped noticeably (AIMD). A drop only counts
+    if the number of active downloads stayed the same. Otherwise it's most likely caused by downloads which finished.
+    """
+    window = 5
+    increase_threshold = 1.05
+    decrease_threshold = 0.8
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.enabled = False
+        self.min_slots = 1
+        self.max_slots = 10
+
+        self._lock = Lock()
+        self._bytes = 0
+        self._errors = 0
+        self._last_check = 0
+        self._last_speed = None
+        self._last_active = None
+        self._sc = SpeedCalc()
+        self._sc.interval = 1
+        self._sc.speeds = deque(maxlen=self.window)
+
+    def configure(self, enabled, slots, min_slots=1, max_slots=10):
+        with self._lock:
+            self.enabled = enabled
+            self.min_slots = min_slots
+            self.max_slots = max(min_slots, max_slots)
+            self._last_speed = None
+            self._last_active = None
+            self._last_check = time.time()
+            self._errors = 0
+
+            if enabled:
+                slots = min(max(slots, self.min_slots), self.max_slots)
+
+            self.pool.set_capacity(slots)
+
+    def add_bytes(self, count):
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._bytes += count
+            self._sc.push(self._bytes)
+
+            now = time.time()
+            if now - self._last_check >= self.window:
+                self._adjust(now)
+
+    def record_error(self):
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._errors += 1
+
+    def _adjust(self, now):
+        speed = self._sc.get_speed()
+        slots = self.pool.get_capacity()
+        active = self.pool.get_consumed()
+        new_slots = slots
+
+        dropped = self._last_speed and speed < self._last_speed * self.decrease_threshold
+        if self._errors > 0 or (dropped and active == self._last_active):
+            new_slots = max(self.min_slots, slots // 2)
+        elif active >= slots and (self._last_speed is None or speed > self._last_speed * self.increase_threshold):
+            new_slots = min(self.max_slots, slots + 1)
+
+        if new_slots != slots:
+            logging.debug('Changing the number of download slots from %d to %d (%s/s, %d errors).',
+                          slots, new_slots, format_bytes(speed), self._errors)
+            self.pool.set_capacity(new_slots)
+
+        self._last_speed = speed
+        self._last_active = active
+        self._last_check = now
+        self._errors = 0
+
+
 def call(*args, **kwargs):
     if sys.platform.startswith('win') and not center.DEBUG:
         # Provide the called program with proper I/O on Windows.
@@ -320,6 +626,7 @@ def head(link, headers=None, random_ua=False, timeout=60):
         result = HTTP_SESSION.head(link, headers=headers, timeout=timeout, allow_redirects=True)
 
         if result.status_code == 304:
+            MIRRORS.record_success(link, result.elapsed.total_seconds())
             return 304
         elif result.status_code != 200:
             result.raise_for_status()
@@ -328,8 +635,11 @@ def head(link, headers=None, random_ua=False, timeout=60):
             logging.exception('Failed to load "%s"!', link)
         else:
             logging.error('Failed to load "%s"! (%d %s)', link, result.status_code, result.reason)
+
+        MIRRORS.record_failure(link)
         return None
 
+    MIRRORS.record_success(link, result.elapsed.total_seconds())
     return result
 
 
@@ -386,10 +696,10 @@ def post(link, data, headers=None, random_ua=False):
     return result.text
 
 
-def _limited_request_iter(result, chunk_size):
+def _limited_request_iter(result, chunk_size, limiter):
     iterator = result.iter_content(chunk_size)
     while True:
-        if not SPEED_LIMIT_BUCKET.wait_for_consume(chunk_size, _DL_CANCEL):
+        if not limiter.wait_for_consume(chunk_size, _DL_CANCEL):
             return
 
         try:
@@ -398,26 +708,35 @@ def _limited_request_iter(result, chunk_size):
             return
 
 
-def _get_download_iterator(result, chunk_size):
-    if center.settings['download_bandwidth'] < 0.0:
+def _get_download_iterator(result, chunk_size, limiter=None):
+    limiter = limiter or SPEED_LIMIT_BUCKET
+    if limiter.get_rate() < 0:
         # There is no bandwidth limit so just use the normal download method
         return result.iter_content(chunk_size)
     else:
-        return _limited_request_iter(result, chunk_size)
+        return _limited_request_iter(result, chunk_size, limiter)
 
 
-def _get_download_chunk_size():
+def _get_download_chunk_size(limiter=None):
     DEFAULT_CHUNK_SIZE = 512 * 1024
-    if center.settings['download_bandwidth'] < 0.0:
+    rate = (limiter or SPEED_LIMIT_BUCKET).get_rate()
+
+    if rate < 0:
         # If there is no bandwidth limit then this should work reasonably well
         return DEFAULT_CHUNK_SIZE
     else:
         # If there is a bandwidth limit then for small limits a too large chunk size will make the GUI appear frozen
         # while the chunk is being downloaded. This will make sure that the GUI is updated twice a second
-        return min(int(center.settings['download_bandwidth'] / 2), DEFAULT_CHUNK_SIZE)
+        return max(min(int(rate / 2), DEFAULT_CHUNK_SIZE), 1024)
+
 
+def download(link, dest, headers=None, random_ua=False, timeout=60, continue_=False, get_etag=False, hasher=None,
+             limiter=None):
+    """Downloads link into the file object dest.
 
-def download(link, dest, headers=None, random_ua=False, timeout=60, continue_=False, get_etag=False):
+    If a DownloadHash is passed as hasher, it's updated with everything written to dest.
+    limiter is the RateLimiter to use, SPEED_LIMIT_BUCKET by default.
+    """
     global HTTP_SESSION, DL_POOL, _DL_CANCEL
 
     if headers is None:
@@ -442,9 +761,13 @@ def download(link, dest, headers=None, random_ua=False, timeout=60, continue_=Fa
             result = HTTP_SESSION.get(link, headers=headers, stream=True, timeout=timeout)
         except requests.exceptions.ConnectionError:
             logging.exception('Failed to load "%s"!', link)
+            MIRRORS.record_failure(link)
+            DL_TUNER.record_error()
             return False
 
+        ttfb = time.time() - start
         if result.status_code == 304:
+            MIRRORS.record_success(link, ttfb)
             return 304
         elif result.status_code == 206:
             if not continue_:
@@ -452,6 +775,7 @@ def download(link, dest, headers=None, random_ua=False, timeout=60, continue_=Fa
                 logging.warning('"%s" returned "206 Partial Content", the downloaded file might be incomplete.', link)
         elif result.status_code != 200:
             logging.error('Failed to load "%s"! (%d %s)', link, result.status_code, result.reason)
+            MIRRORS.record_failure(link)
             return False
 
         try:
@@ -462,15 +786,28 @@ def download(link, dest, headers=None, random_ua=False, timeout=60, continue_=Fa
 
         if result.status_code != 206 or not continue_:
             dest.seek(0)
-        elif size > 0:
-            # Since content-length is the remainder of the data to get, add in what we've already
-            # downloaded so that our progress math is correct
-            size += dest.tell()
+            dest.truncate()
 
+            if hasher:
+                hasher.reset()
+        else:
+            if hasher:
+                hasher.catch_up(dest)
+
+            if size > 0:
+                # Since content-length is the remainder of the data to get, add in what we've already
+                # downloaded so that our progress math is correct
+                size += dest.tell()
+
+        offset = dest.tell()
         try:
             sc = SpeedCalc()
-            for chunk in _get_download_iterator(result, _get_download_chunk_size()):
+            for chunk in _get_download_iterator(result, _get_download_chunk_size(limiter), limiter):
                 dest.write(chunk)
+                if hasher:
+                    hasher.update(chunk)
+
+                DL_TUNER.add_bytes(len(chunk))
 
                 if sc.push(dest.tell()) != -1:
                     if size > 0:
@@ -488,6 +825,8 @@ def download(link, dest, headers=None, random_ua=False, timeout=60, continue_=Fa
                     return False
         except Exception:
             logging.exception('Download of "%s" was interrupted!', link)
+            MIRRORS.record_failure(link)
+            DL_TUNER.record_error()
             return False
         else:
             duration = time.time() - start
@@ -505,7 +844,11 @@ def download(link, dest, headers=None, random_ua=False, timeout=60, continue_=Fa
     # continuing where we left off
     if size > 0 and dest.tell() < int(size):
         logging.warn('Download of "%s" was cut off with %d bytes to go! Retrying...', link, size - dest.tell())
-        return download(link, dest, headers, False, timeout, True, get_etag)
+        MIRRORS.record_failure(link)
+        DL_TUNER.record_error()
+        return download(link, dest, headers, False, timeout, True, get_etag, hasher, limiter)
+
+    MIRRORS.record_success(link, ttfb, dest.tell() - offset, duration)
 
     if get_etag:
         return result.headers.get('etag', True)
@@ -513,6 +856,182 @@ def download(link, dest, headers=None, random_ua=False, timeout=60, continue_=Fa
     return True
 
 
+class _Segment(object):
+    __slots__ = ('start', 'end', 'pos', 'failures', 'last_url')
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.pos = start
+        self.failures = 0
+        self.last_url = None
+
+
+def _download_segment(seg, link, stream, state, timeout):
+    """Fetches the rest of seg from link and writes it to stream. Returns True if the segment is complete."""
+    headers = {'Range': 'bytes=%d-%d' % (seg.pos, seg.end - 1)}
+
+    with DL_POOL:
+        if _DL_CANCEL.is_set():
+            return False
+
+        start = time.time()
+        try:
+            result = HTTP_SESSION.get(link, headers=headers, stream=True, timeout=timeout)
+        except requests.exceptions.ConnectionError:
+            logging.exception('Failed to load "%s"!', link)
+            MIRRORS.record_failure(link)
+            DL_TUNER.record_error()
+            return False
+
+        ttfb = time.time() - start
+        if result.status_code == 200:
+            # The mirror ignored our Range header. We can't use it for this download.
+            logging.warning('"%s" doesn\'t support range requests!', link)
+            result.close()
+            MIRRORS.record_no_range(link)
+            return False
+        elif result.status_code != 206 or \
+                not result.headers.get('content-range', '').startswith('bytes %d-' % seg.pos):
+            logging.error('Failed to load "%s" (%d %s)!', link, result.status_code, result.reason)
+            result.close()
+            MIRRORS.record_failure(link)
+            DL_TUNER.record_error()
+            return False
+
+        offset = seg.pos
+        try:
+            stream.seek(seg.pos)
+            for chunk in _get_download_iterator(result, _get_download_chunk_size()):
+                chunk = chunk[:seg.end - seg.pos]
+                stream.write(chunk)
+                seg.pos += len(chunk)
+
+                with state['lock']:
+                    state['done'] += len(chunk)
+
+                DL_TUNER.add_bytes(len(chunk))
+
+                if seg.pos >= seg.end or _DL_CANCEL.is_set() or state['failed']:
+                    break
+        except Exception:
+            logging.exception('Segment %d-%d of "%s" was interrupted!', seg.start, seg.end, link)
+            MIRRORS.record_failure(link)
+            DL_TUNER.record_error()
+            return False
+        finally:
+            result.close()
+
+    if seg.pos >= seg.end:
+        MIRRORS.record_success(link, ttfb, seg.pos - offset, time.time() - start)
+        return True
+
+    return False
+
+
+def _segment_worker(idx, urls, path, segments, state, timeout):
+    with open(path, 'r+b') as stream:
+        while not _DL_CANCEL.is_set() and not state['failed']:
+            with state['lock']:
+                if not segments:
+                    return
+
+                usable = [u for u in urls if MIRRORS.supports_range(u)]
+                if not usable:
+                    logging.warning('None of the mirrors for %s support range requests!', path)
+                    state['failed'] = True
+                    return
+
+                seg = segments.popleft()
+
+                # Spread the workers across the mirrors (best first) but prefer the ones that work and don't retry a
+                # segment on the mirror that just failed it.
+                ranked = MIRRORS.rank(usable, seg.end - seg.pos)
+                order = ranked[idx % len(usable):] + ranked[:idx % len(usable)]
+                order.sort(key=lambda u: (u == seg.last_url, MIRRORS.is_blocked(u), state['mirror_failures'][u]))
+                link = order[0]
+
+            if _download_segment(seg, link, stream, state, timeout):
+                continue
+
+            with state['lock']:
+                seg.failures += 1
+                seg.last_url = link
+                state['mirror_failures'][link] += 1
+
+                if seg.failures > state['max_tries']:
+                    logging.error('Giving up on segment %d-%d of %s!', seg.start, seg.end, path)
+                    state['failed'] = True
+                else:
+                    segments.append(seg)
+
+            time.sleep(min(MIRRORS.get_backoff(link), 5))
+
+
+def download_segmented(urls, path, size, segment_size=None, connections=4, timeout=60):
+    """Downloads a file of a known size from several mirrors at once.
+
+    The file is split into segments which are fetched in parallel with HTTP range requests and written into a
+    preallocated file at path. Failed segments are retried on other mirrors. Mirrors which don't support range requests
+    are skipped. The result isn't verified, the caller has to check the whole file's checksum.
+    """
+    if segment_size is None:
+        segment_size = SEGMENT_SIZE
+
+    urls = [url for url in urls if MIRRORS.supports_range(url)]
+    if not urls:
+        return False
+
+    segments = deque(_Segment(start, min(start + segment_size, size)) for start in range(0, size, segment_size))
+    state = {
+        'lock': Lock(),
+        'done': 0,
+        'failed': False,
+        'max_tries': len(urls) * 3,
+        'mirror_failures': dict((u, 0) for u in urls)
+    }
+
+    with open(path, 'wb') as stream:
+        stream.truncate(size)
+
+    logging.info('Downloading "%s" in %d segments from %d mirrors...', os.path.basename(path), len(segments), len(urls))
+    connections = max(1, min(connections, len(segments)))
+    sc = SpeedCalc()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as pool:
+        futures = [pool.submit(_segment_worker, i, urls, path, segments, state, timeout) for i in range(connections)]
+
+        # Progress is tracked per thread so it has to be reported from here.
+        pending = futures
+        while pending:
+            _, pending = concurrent.futures.wait(pending, timeout=0.5)
+
+            by_done = state['done']
+            if sc.push(by_done) != -1:
+                speed = sc.get_speed()
+                text = format_bytes(speed) + '/s, '
+                text += time.strftime('%M:%S', time.gmtime((size - by_done) / speed)) + ' left'
+                progress.update(by_done / size, text)
+
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                logging.exception('A download segment worker for "%s" failed!', path)
+                state['failed'] = True
+
+    if _DL_CANCEL.is_set() or state['failed'] or segments:
+        return False
+
+    return True
+
+
+def configure_downloads():
+    settings = center.settings
+    DL_TUNER.configure(settings['download_autotune'], settings['max_downloads'], settings['download_slots_min'],
+                       settings['download_slots_max'])
+
+
 def cancel_downloads():
     global _DL_CANCEL, DL_POOL
 
@@ -585,36 +1104,196 @@ def url_join(a, b):
     return pjoin(a, b)
 
 
-def gen_hash(path, algo='sha256', use_hash_cache=True):
-    global HASH_CACHE
+class HashService(object):
+    """Calculates checksums on a bounded pool of worker threads.
 
+    hashlib releases the GIL while it's working so several files can be hashed at once. Progress has to be reported by
+    the thread that submitted the work since progress is tracked per thread.
+    """
+
+    def __init__(self, workers=4):
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, path, algo='sha256', use_hash_cache=True):
+        return self._pool.submit(gen_hash, path, algo, use_hash_cache)
+
+    def submit_many(self, paths, algo='sha256', use_hash_cache=True):
+        return [self.submit(path, algo, use_hash_cache) for path in paths]
+
+    def check_many(self, items, use_hash_cache=True):
+        """Takes a list of (checksum, path) tuples and returns a future for each which resolves to check_hash()'s result."""
+        return [self._pool.submit(check_hash, value, path, use_hash_cache) for value, path in items]
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+
+def _get_hash_buffer():
+    # Every thread reuses its own buffer instead of allocating a new bytes object per chunk.
+    buf = getattr(_HASH_BUFFERS, 'buf', None)
+    if buf is None or len(buf) != HASH_BUFSIZE:
+        buf = _HASH_BUFFERS.buf = bytearray(HASH_BUFSIZE)
+
+    return buf
+
+
+def hash_file(path, algos=('sha256',), strategy=None):
+    """Calculates one or more checksums for the file at path in a single pass.
+
+    Returns a dict mapping each algorithm to the hex digest. strategy can be 'read' (small chunks, the old way),
+    'readinto' (reuses a HASH_BUFSIZE buffer) or 'mmap'. By default files larger than HASH_MMAP_THRESHOLD are mapped
+    and everything else is read with readinto().
+    """
+    hashers = [hashlib.new(algo) for algo in algos]
+
+    with open(path, 'rb') as stream:
+        if strategy is None:
+            size = os.fstat(stream.fileno()).st_size
+            strategy = 'mmap' if size >= HASH_MMAP_THRESHOLD else 'readinto'
+
+        if strategy == 'mmap':
+            try:
+                data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                # Empty files can't be mapped.
+                strategy = 'readinto'
+            else:
+                with data:
+                    view = memoryview(data)
+                    try:
+                        if len(hashers) == 1:
+                            hashers[0].update(view)
+                        else:
+                            # Feed all digests one chunk at a time while it's still in the CPU cache.
+                            for pos in range(0, len(view), HASH_BUFSIZE):
+                                chunk = view[pos:pos + HASH_BUFSIZE]
+                                for h in hashers:
+                                    h.update(chunk)
+
+                                chunk.release()
+                    finally:
+                        view.release()
+
+        if strategy == 'readinto':
+            buf = _get_hash_buffer()
+            view = memoryview(buf)
+
+            while True:
+                count = stream.readinto(buf)
+                if not count:
+                    break
+
+                for h in hashers:
+                    h.update(view[:count])
+        elif strategy == 'read':
+            while True:
+                chunk = stream.read(16 * hashers[0].block_size)
+                if not chunk:
+                    break
+
+                for h in hashers:
+                    h.update(chunk)
+
+    return {algo: h.hexdigest() for algo, h in zip(algos, hashers)}
+
+
+def hash_stream(stream, algo='sha256'):
+    """Reads the file object stream until the end and returns its checksum (hex digest).
+
+    stream has to support readinto(). The data is read into the calling thread's hash buffer.
+    """
+    h = hashlib.new(algo)
+    view = memoryview(_get_hash_buffer())
+
+    try:
+        while True:
+            count = stream.readinto(view)
+            if not count:
+                break
+
+            h.update(view[:count])
+    finally:
+        view.release()
+
+    return h.hexdigest()
+
+
+class _PathLock(object):
+    # Makes sure that each file is only hashed once at a time without serializing unrelated files.
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        with _HASH_PATH_LOCKS_LOCK:
+            entry = _HASH_PATH_LOCKS.get(self.path)
+            if entry is None:
+                entry = _HASH_PATH_LOCKS[self.path] = [Lock(), 0]
+
+            entry[1] += 1
+
+        entry[0].acquire()
+
+    def __exit__(self, *exc):
+        with _HASH_PATH_LOCKS_LOCK:
+            entry = _HASH_PATH_LOCKS[self.path]
+            entry[0].release()
+
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _HASH_PATH_LOCKS[self.path]
+
+
+def gen_hash(path, algo='sha256', use_hash_cache=True):
     path = os.path.abspath(path)
     info = os.stat(path)
+    use_hash_cache = use_hash_cache and algo == 'sha256'
 
-    if use_hash_cache and algo == 'sha256' and path in HASH_CACHE:
-        chksum, mtime = HASH_CACHE[path]
-        if mtime == info.st_mtime:
+    if use_hash_cache:
+        chksum = HASH_CACHE.get(path, info)
+        if chksum:
             # logging.debug('Found checksum for %s in cache.', path)
             return algo, chksum
 
-    with HASH_LOCK:
+    with _PathLock(path):
+        if use_hash_cache:
+            # Another thread might have hashed this file while we were waiting.
+            chksum = HASH_CACHE.get(path, info)
+            if chksum:
+                return algo, chksum
+
         logging.debug('Calculating checksum for %s...', path)
+        chksum = hash_file(path, (algo,))[algo]
 
-        h = hashlib.new(algo)
-        with open(path, 'rb') as stream:
-            while True:
-                chunk = stream.read(16 * h.block_size)
-                if not chunk:
-                    break
+        if algo == 'sha256':
+            HASH_CACHE.put(path, info, chksum)
 
-                h.update(chunk)
+    return algo, chksum
 
-        chksum = h.hexdigest()
 
-    if algo == 'sha256':
-        HASH_CACHE[path] = (chksum, info.st_mtime)
+def seed_hash(value, path):
+    """Records a checksum we already know (i.e. from a verified archive) for path in the hash cache."""
+    algo, chksum = value
+    if algo != 'sha256':
+        return
+
+    path = os.path.abspath(path)
+    HASH_CACHE.put(path, os.stat(path), chksum)
 
-    return algo, chksum
+
+def get_manifest_entry(path, value):
+    """Returns the entry describing path for a mod's file manifest or None if the file is missing.
+
+    The entry combines the file's size, mtime and inode with the checksum it's expected to have. A file whose entry
+    still matches the one recorded when it was last verified doesn't have to be hashed again. The inode catches files
+    which were replaced by a copy that kept the old mtime.
+    """
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+
+    return [info.st_size, info.st_mtime_ns, info.st_ino, list(value)]
 
 
 def check_hash(value, path, use_hash_cache=True):
@@ -648,21 +1327,29 @@ def test_7z():
             return False
 
 
-def extract_archive(archive, outpath, overwrite=False, files=None, _rec=False):
+def extract_archive(archive, outpath, overwrite=False, files=None, _rec=False, name=None):
+    """Extracts archive into outpath with tar or 7z and returns True on success.
+
+    The format is determined by the file extension of name (which defaults to archive). Pass the original filename if
+    the archive was renamed (i.e. by the archive cache).
+    """
     global _HAS_TAR
 
-    if archive.endswith(('.tar.gz', '.tar.xz', '.tar.bz2', '.tgz')):
+    if name is None:
+        name = archive
+
+    if name.endswith(('.tar.gz', '.tar.xz', '.tar.bz2', '.tgz')):
         if _HAS_TAR is None:
             _HAS_TAR = call(['tar', '--version'], stdout=subprocess.DEVNULL) == 0
 
         if _HAS_TAR:
             cmd = ['tar', '-xf', archive, '-C', outpath]
 
-            if archive.endswith(('.gz', '.tgz')):
+            if name.endswith(('.gz', '.tgz')):
                 cmd.append('-z')
-            elif archive.endswith('.xz'):
+            elif name.endswith('.xz'):
                 cmd.append('-J')
-            elif archive.endswith('.bz2'):
+            elif name.endswith('.bz2'):
                 cmd.append('-j')
 
             if overwrite:
@@ -682,24 +1369,20 @@ def extract_archive(archive, outpath, overwrite=False, files=None, _rec=False):
         if not _rec:
             # This is a file like whatever.tar.gz. We have to call 7z two times for this kind of file:
             # First to get whatever.tar and a second time to extract that tar archive.
+            # We can't predict the name of the tar archive if the archive was renamed but it's the only file in the
+            # temporary directory.
 
-            if not extract_archive(archive, os.path.dirname(archive), True, None, True):
-                return False
-
-            unc_archive = archive.split('.')
-            # Remove the .gz or .bz2 or whatever ending...
-            if unc_archive.pop() == 'tgz':
-                unc_archive.append('tar')
+            with tempfile.TemporaryDirectory() as tp:
+                if not extract_archive(archive, tp, True, None, True):
+                    return False
 
-            # ... and put it together again.
-            unc_archive = '.'.join(unc_archive)
-            res = extract_archive(unc_archive, outpath, overwrite, files, True)
+                unc_archive = os.listdir(tp)
+                if len(unc_archive) != 1:
+                    return False
 
-            # Cleanup
-            os.unlink(unc_archive)
-            return res
+                return extract_archive(os.path.join(tp, unc_archive[0]), outpath, overwrite, files, True)
 
-    if archive.endswith('.dmg') and not _rec:
+    if name.endswith('.dmg') and not _rec:
         # We have to call 7z twice for this file type. The first time, 7z only extracts the section contained in the file.
         # The second time, 7z extracts the actual contents from the HFS image.
 
@@ -730,6 +1413,165 @@ def extract_archive(archive, outpath, overwrite=False, files=None, _rec=False):
         return call(cmd) == 0
 
 
+# The standard library can't read 7z archives (which is what most mods use) so those still go through extract_archive()
+# and a temporary directory.
+STREAM_EXTRACT_EXTS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.xz', '.tar.bz2')
+
+
+def can_stream_extract(archive):
+    """Returns True if stream_extract() can handle the archive. This is never the case for 7z archives."""
+    return archive.lower().endswith(STREAM_EXTRACT_EXTS)
+
+
+def _normalize_member(name):
+    parts = [p for p in name.replace('\\', '/').split('/') if p not in ('', '.')]
+    if '..' in parts:
+        return None
+
+    return '/'.join(parts).lower()
+
+
+def _is_safe_link(target):
+    """Returns False if the symlink target could point outside of the folder the link is created in."""
+    target = target.replace('\\', '/')
+    if target.startswith('/') or re.match(r'^[a-zA-Z]:', target):
+        return False
+
+    return '..' not in target.split('/')
+
+
+def _extract_member(src, dest_path, value):
+    """Writes src to dest_path while hashing it. Returns False (and removes the file) if the checksum doesn't match."""
+    algo, chksum = value
+    hasher = hashlib.new(algo)
+    buf = _get_hash_buffer()
+    view = memoryview(buf)
+    tmp_path = dest_path + '.kn_part'
+
+    try:
+        with open(tmp_path, 'wb') as dest:
+            while True:
+                count = src.readinto(view)
+                if not count:
+                    break
+
+                hasher.update(view[:count])
+                dest.write(view[:count])
+    finally:
+        view.release()
+
+    if hasher.hexdigest() != chksum:
+        logging.error('Extracted file "%s" is corrupted!' % dest_path)
+        os.unlink(tmp_path)
+        return False
+
+    os.replace(tmp_path, dest_path)
+
+    if algo == 'sha256':
+        HASH_CACHE.put(os.path.abspath(dest_path), os.stat(dest_path), chksum)
+
+    return True
+
+
+def _iter_zip(archive):
+    with zipfile.ZipFile(archive) as zf:
+        for info in zf.infolist():
+            mode = info.external_attr >> 16
+            if info.is_dir():
+                yield info.filename, 'dir', None
+            elif mode & 0o170000 == 0o120000:
+                yield info.filename, 'link', zf.read(info).decode('utf8')
+            else:
+                with zf.open(info) as src:
+                    yield info.filename, 'file', src
+
+
+def _iter_tar(archive):
+    # Stream mode only reads the archive once which is a lot faster for compressed archives.
+    with tarfile.open(archive, 'r|*') as tf:
+        for member in tf:
+            if member.isdir():
+                yield member.name, 'dir', None
+            elif member.issym():
+                yield member.name, 'link', member.linkname
+            elif member.islnk():
+                yield member.name, 'hardlink', member.linkname
+            elif member.isfile():
+                yield member.name, 'file', tf.extractfile(member)
+
+
+def stream_extract(archive, targets, extra_root=None):
+    """Extracts the needed members of a zip or tar archive directly to their final location.
+
+    7z archives aren't supported (see can_stream_extract()). They're still extracted by the 7z executable into a
+    temporary directory first.
+
+    targets maps member names to (dest_path, checksum) tuples. Every member is hashed while it's written and only
+    replaces dest_path if the checksum matches. Other members are skipped except for directories and symlinks which are
+    recreated below extra_root (if given). Symlinks with absolute targets or targets containing ".." are skipped.
+
+    Returns the set of target names which are missing from the archive or failed to extract.
+    """
+    wanted = {}
+    for name, target in targets.items():
+        wanted[_normalize_member(name)] = (name, target)
+
+    # Cached archives are named after their checksum so we can't rely on the extension here.
+    if zipfile.is_zipfile(archive):
+        members = _iter_zip(archive)
+    else:
+        members = _iter_tar(archive)
+
+    done = {}
+    count = float(max(1, len(wanted)))
+
+    for name, kind, data in members:
+        norm = _normalize_member(name)
+        if norm is None:
+            logging.warning('Skipping suspicious member "%s" in "%s".' % (name, archive))
+            continue
+        elif norm == '':
+            # The archive's root directory
+            continue
+
+        if norm in wanted:
+            orig_name, (dest_path, chksum) = wanted[norm]
+            progress.update(len(done) / count, orig_name)
+
+            parent = os.path.dirname(dest_path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+
+            if kind == 'file':
+                done[norm] = _extract_member(data, dest_path, chksum)
+            elif kind == 'hardlink' and _normalize_member(data) in done:
+                # The target was extracted before so we can just copy it.
+                link_dest = wanted[_normalize_member(data)][1][0]
+                with open(link_dest, 'rb') as src:
+                    done[norm] = _extract_member(src, dest_path, chksum)
+            else:
+                logging.error('Member "%s" in "%s" is not a regular file!' % (name, archive))
+                done[norm] = False
+        elif extra_root and kind in ('dir', 'link'):
+            parts = [p for p in name.replace('\\', '/').split('/') if p not in ('', '.')]
+            dest_path = ipath(os.path.join(extra_root, *parts))
+
+            if kind == 'dir':
+                if not os.path.isdir(dest_path):
+                    os.makedirs(dest_path)
+            elif not _is_safe_link(data):
+                logging.warning('Skipping symlink "%s" with unsafe target "%s" in "%s".' % (name, data, archive))
+            elif not os.path.lexists(dest_path):
+                parent = os.path.dirname(dest_path)
+                if not os.path.isdir(parent):
+                    os.makedirs(parent)
+
+                os.symlink(data, dest_path)
+
+    progress.update(1, 'Done.')
+    return set(wanted[norm][0] for norm in wanted if not done.get(norm))
+
+
 def init_ui(ui, win):
     ui.setupUi(win)
     for attr in ui.__dict__:
@@ -792,36 +1634,49 @@ def is_fs2_retail_directory(path):
     return False
 
 
-def extract_vp_file(vp_path, dest_path):
+def _extract_vp_entry(vp_reader, path, dest):
+    with open(dest, 'wb') as dest_hdl:
+        return vp_reader.copy_to(path, dest_hdl)
+
+
+def extract_vp_file(vp_path, dest_path, threads=4):
     if not os.path.isdir(dest_path):
         os.makedirs(dest_path)
 
-    vp_reader = VpReader(vp_path)
+    with VpReader(vp_path) as vp_reader:
+        # Create all directories in one pass and map each file to its (case insensitive) destination.
+        dirs = {}
+        plan = []
+        for path in vp_reader.files:
+            parent, name = os.path.split(path)
 
-    fc = float(len(vp_reader.files))
-    done = 0
-    for path, meta in vp_reader.files.items():
-        progress.update(done / fc, path)
-        hdl = vp_reader.open_file(path)
+            if parent not in dirs:
+                sub_par = ipath(os.path.join(dest_path, parent))
+                if os.path.isdir(sub_par):
+                    dirs[parent] = (sub_par, {item.lower(): item for item in os.listdir(sub_par)})
+                else:
+                    os.makedirs(sub_par)
+                    dirs[parent] = (sub_par, {})
 
-        sub_dest = ipath(os.path.join(dest_path, path))
-        sub_par = os.path.dirname(sub_dest)
+            sub_par, existing = dirs[parent]
+            plan.append((path, os.path.join(sub_par, existing.get(name, name))))
 
-        if not os.path.isdir(sub_par):
-            os.makedirs(sub_par)
+        total = float(max(1, sum(vp_reader.files.sizes)))
+        done = 0
 
-        with open(sub_dest, 'wb') as dest_hdl:
-            remaining = meta['size']
-            bufsize = 16 * 1024  # 16 KiB
-            while remaining > 0:
-                buf = hdl.read(min(remaining, bufsize))
-                if not buf:
-                    break
+        # Progress is tracked per thread so all updates have to happen in this thread.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+            futures = {pool.submit(_extract_vp_entry, vp_reader, path, dest): path for path, dest in plan}
 
-                dest_hdl.write(buf)
-                remaining -= bufsize
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    done += future.result()
+                    progress.update(done / total, futures[future])
+            except BaseException:
+                for future in futures:
+                    future.cancel()
 
-        done += 1
+                raise
 
 
 def enable_raven():
@@ -905,12 +1760,12 @@ def safe_copy(a, b):
         return shutil.copyfile(a, b)
 
 
-def safe_download(url, dest):
+def safe_download(url, dest, limiter=None):
     retries = 5
 
     while retries > 0:
         with open(dest, 'wb') as stream:
-            if download(url, stream):
+            if download(url, stream, limiter=limiter):
                 return True
 
         retries -= 1
@@ -928,6 +1783,25 @@ def _safe_download(url, dest):
         download(url, fobj)
 
 
+def get_archive_cache():
+    """Returns the ArchiveCache for the current library or None if it's disabled."""
+    global ARCHIVE_CACHE
+
+    base = center.settings['base_path']
+    size = center.settings['archive_cache_size']
+    if not base or size <= 0:
+        return None
+
+    path = os.path.join(base, 'archive_cache')
+    if ARCHIVE_CACHE is None or ARCHIVE_CACHE.path != path:
+        ARCHIVE_CACHE = ArchiveCache(path, size, HASH_CACHE)
+    else:
+        ARCHIVE_CACHE.max_size = size
+        ARCHIVE_CACHE.hash_cache = HASH_CACHE
+
+    return ARCHIVE_CACHE
+
+
 def ensure_tempdir():
     if center.settings['base_path']:
         path = os.path.join(center.settings['base_path'], 'temp')
@@ -972,8 +1846,13 @@ class Spec(semantic_version.Spec):
 
 
 DL_POOL = ResizableSemaphore(10)
+DL_TUNER = DownloadTuner(DL_POOL)
+MIRRORS = MirrorScoreboard()
+HASH_POOL = HashService()
 HTTP_SESSION.headers['User-Agent'] = get_user_agent()
-SPEED_LIMIT_BUCKET = BlockingTokenBucket(3 * 1024 * 1024)
+SPEED_LIMIT_BUCKET = RateLimiter(-1)
+# Background work (i.e. FixImagesTask) can be limited further (see the background_bandwidth setting).
+BACKGROUND_LIMIT = RateLimiter(-1, parent=SPEED_LIMIT_BUCKET)
 
 if not center.DEBUG:
     logging.getLogger('requests.packages.urllib3.connectionpool').propagate = False
@@ -0,0 +1,208 @@
+## Copyright 2017 Knossos authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+from . import vplib, util
+
+
+class VpPool(object):
+    """Keeps at most size VpReaders open and closes the least recently used one when a new VP is opened."""
+
+    def __init__(self, size=16):
+        self.size = size
+        self._readers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, path):
+        reader = self._readers.get(path)
+        if reader is not None:
+            self._readers.move_to_end(path)
+            return reader
+
+        reader = vplib.VpReader(path)
+        self._readers[path] = reader
+
+        while len(self._readers) > self.size:
+            _, old = self._readers.popitem(last=False)
+            old.close()
+
+        return reader
+
+    def get_index(self, path):
+        with self._lock:
+            return self._get(path).files
+
+    def get_buffer(self, path, entry):
+        # Buffers stay valid even if the reader is closed later on.
+        with self._lock:
+            return self._get(path).get_buffer(entry)
+
+    def close(self):
+        with self._lock:
+            for reader in self._readers.values():
+                reader.close()
+
+            self._readers.clear()
+
+
+class ModVfs(object):
+    """A read-only view of the files FSO sees for a list of mod folders.
+
+    The folders have to be passed in FSO's search order (the first one wins), like InstalledMod.get_mod_flag()
+    returns them. Inside each folder, loose files in data/ take precedence over the VPs which are searched in
+    alphabetical order.
+    """
+
+    def __init__(self, folders, pool=None):
+        self.pool = pool or VpPool()
+
+        # Each source is a (label, location, is_vp) tuple. location is either a VP or a folder.
+        self._sources = []
+        self._index = {}
+        self._shadowed = {}
+
+        for item in folders:
+            if isinstance(item, tuple):
+                path, label = item
+            else:
+                path, label = item, os.path.basename(item)
+
+            self._add_folder(path, label)
+
+    def _add_source(self, label, location, is_vp, paths):
+        sid = len(self._sources)
+        self._sources.append((label, location, is_vp))
+
+        index = self._index
+        for path in paths:
+            winner = index.setdefault(path, sid)
+            if winner != sid:
+                self._shadowed.setdefault(path, []).append(sid)
+
+    def _scan_dir(self, path, prefix, result):
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        self._scan_dir(entry.path, prefix + entry.name.lower() + '/', result)
+                    else:
+                        result.append(prefix + entry.name.lower())
+        except OSError:
+            logging.warning('Failed to scan "%s"!' % path)
+
+    def _add_folder(self, path, label):
+        try:
+            items = os.listdir(path)
+        except OSError:
+            logging.warning('Skipping mod folder "%s" since it can\'t be read.' % path)
+            return
+
+        vps = []
+        for name in items:
+            lname = name.lower()
+
+            if lname == 'data' and os.path.isdir(os.path.join(path, name)):
+                loose = []
+                self._scan_dir(os.path.join(path, name), 'data/', loose)
+                self._add_source(label, path, False, loose)
+            elif lname.endswith('.vp'):
+                vps.append(name)
+
+        for name in sorted(vps, key=str.lower):
+            vp_path = os.path.join(path, name)
+
+            try:
+                files = self.pool.get_index(vp_path)
+            except Exception:
+                logging.exception('Failed to read "%s"!' % vp_path)
+                continue
+
+            if files is None:
+                continue
+
+            self._add_source(label, vp_path, True, files)
+
+    def _normalize(self, path):
+        return path.replace('\\', '/').lower()
+
+    def _describe(self, sid, path):
+        label, location, is_vp = self._sources[sid]
+        if not is_vp:
+            location = util.ipath(os.path.join(location, path))
+
+        return label, location
+
+    def __contains__(self, path):
+        return self._normalize(path) in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def which(self, path):
+        """Returns (label, location) for the copy of path FSO would load or None if no mod has it.
+
+        location is either the loose file or the VP that contains path.
+        """
+        path = self._normalize(path)
+        sid = self._index.get(path)
+        if sid is None:
+            return None
+
+        return self._describe(sid, path)
+
+    def open(self, path):
+        path = self._normalize(path)
+        label, location, is_vp = self._sources[self._index[path]]
+
+        if is_vp:
+            return vplib.VpFileView(self.pool.get_buffer(location, path))
+        else:
+            return open(util.ipath(os.path.join(location, path)), 'rb')
+
+    def get_conflicts(self):
+        """Returns a dict mapping each path that exists more than once to all of its (label, location) pairs.
+
+        The first pair is the one FSO would load.
+        """
+        result = {}
+        for path, shadowed in self._shadowed.items():
+            result[path] = [self._describe(sid, path) for sid in [self._index[path]] + shadowed]
+
+        return result
+
+    def get_overrides(self, label):
+        """Returns the paths where the mod with the given label replaces a file from another mod."""
+        result = []
+        for path, shadowed in self._shadowed.items():
+            if self._sources[self._index[path]][0] != label:
+                continue
+
+            for sid in shadowed:
+                if self._sources[sid][0] != label:
+                    result.append(path)
+                    break
+
+        return result
+
+    def close(self):
+        self.pool.close()
@@ -14,16 +14,75 @@
 
 from __future__ import print_function
 
+import sys
 import struct
 import os
+import io
+import errno
+import mmap
 import logging
-import shutil
+import hashlib
+import threading
+import tempfile
 
+from array import array
 from time import time
 
 from knossos import progress
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 # See also: http://docs.python.org/library/struct.html#format-characters
 
+TOC_ENTRY = struct.Struct('<ii32si')
+_COPY_UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EBADF, errno.EOPNOTSUPP, errno.ENOTSUP)
+_use_copy_file_range = hasattr(os, 'copy_file_range')
+# sendfile() only accepts regular files as output on Linux.
+_use_sendfile = hasattr(os, 'sendfile') and sys.platform.startswith('linux')
+
+# Set to a TocCache to reuse parsed TOCs across VpReader instances (and runs).
+TOC_CACHE = None
+
+
+def copy_range(src_fd, offset, size, dest_fd):
+    """Copies size bytes starting at offset in src_fd to the current position of dest_fd inside the kernel.
+
+    Returns the number of bytes copied which is less than size if the platform (or file system) doesn't support
+    this. The caller has to copy the rest itself.
+    """
+    global _use_copy_file_range, _use_sendfile
+
+    done = 0
+    while done < size:
+        try:
+            if _use_copy_file_range:
+                count = os.copy_file_range(src_fd, dest_fd, size - done, offset + done)
+            elif _use_sendfile:
+                count = os.sendfile(dest_fd, src_fd, offset + done, size - done)
+            else:
+                break
+        except OSError as exc:
+            if exc.errno not in _COPY_UNSUPPORTED:
+                raise
+
+            if _use_copy_file_range:
+                # copy_file_range() doesn't work across file systems on older kernels.
+                _use_copy_file_range = False
+            else:
+                _use_sendfile = False
+
+            continue
+
+        if count == 0:
+            # EOF
+            break
+
+        done += count
+
+    return done
+
 
 class EmptyFileException(Exception):
     def __init__(self, fn):
@@ -96,9 +155,303 @@ class DataWriter(object):
         self.pack(str(length) + 's', value)
 
 
+class VpIndex(Mapping):
+    """A compact index of the files in a VP.
+
+    The entries are stored in parallel arrays. Lookups return the same dicts as the old
+    files dict ({'offset': ..., 'size': ..., 'timestamp': ...}) so existing code keeps working.
+    """
+    __slots__ = ('paths', 'offsets', 'sizes', 'timestamps', '_lookup')
+
+    def __init__(self, paths=(), offsets=(), sizes=(), timestamps=()):
+        self.paths = list(map(sys.intern, paths))
+        self.offsets = array('i', offsets)
+        self.sizes = array('i', sizes)
+        self.timestamps = array('i', timestamps)
+        self._lookup = dict(zip(self.paths, range(len(self.paths))))
+
+        if len(self._lookup) != len(self.paths):
+            self._remove_duplicates()
+
+    def _remove_duplicates(self):
+        # Later entries win, just like they did with the old dict.
+        keep = sorted(self._lookup.values())
+
+        self.paths = [self.paths[i] for i in keep]
+        self.offsets = array('i', [self.offsets[i] for i in keep])
+        self.sizes = array('i', [self.sizes[i] for i in keep])
+        self.timestamps = array('i', [self.timestamps[i] for i in keep])
+        self._lookup = dict(zip(self.paths, range(len(self.paths))))
+
+    def add(self, path, offset, size, timestamp):
+        idx = self._lookup.get(path)
+        if idx is None:
+            self._lookup[sys.intern(path)] = len(self.paths)
+            self.paths.append(path)
+            self.offsets.append(offset)
+            self.sizes.append(size)
+            self.timestamps.append(timestamp)
+        else:
+            self.offsets[idx] = offset
+            self.sizes[idx] = size
+            self.timestamps[idx] = timestamp
+
+    def get_entry(self, path):
+        idx = self._lookup[path]
+        return self.offsets[idx], self.sizes[idx]
+
+    def __getitem__(self, path):
+        idx = self._lookup[path]
+        return {
+            'offset': self.offsets[idx],
+            'size': self.sizes[idx],
+            'timestamp': self.timestamps[idx]
+        }
+
+    def __contains__(self, path):
+        return path in self._lookup
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+
+class TocCache(object):
+    """Stores parsed VP TOCs in a directory, one file per VP.
+
+    Each entry records the path, size, mtime and inode of the VP it was created from. Entries for VPs that changed since
+    are ignored and replaced the next time the VP is parsed. prune() removes the entries of VPs which no longer exist and
+    the least recently used entries once there are more than max_entries.
+    """
+    HEADER = struct.Struct('<4sIQqQiII')
+    MAGIC = b'KVTC'
+    VERSION = 2
+    max_entries = 5000
+
+    def __init__(self, path):
+        self.path = path
+
+    def _get_name(self, vp_path):
+        key = os.path.normcase(os.path.abspath(vp_path)).encode('utf8', 'surrogateescape')
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest() + '.toc')
+
+    def load(self, vp_path, info):
+        """Returns (VpIndex, TOC offset) for the VP with the given os.stat() result or None."""
+        try:
+            with open(self._get_name(vp_path), 'rb') as stream:
+                data = stream.read()
+        except (IOError, OSError):
+            return None
+
+        hsize = self.HEADER.size
+        if len(data) < hsize:
+            return None
+
+        magic, version, size, mtime, inode, toc_offset, count, name_len = self.HEADER.unpack_from(data)
+        if magic != self.MAGIC or version != self.VERSION or \
+                (size, mtime, inode) != (info.st_size, info.st_mtime_ns, info.st_ino):
+            return None
+
+        try:
+            arrays = []
+            pos = hsize + name_len
+            for i in range(3):
+                values = array('i')
+                values.frombytes(data[pos:pos + count * values.itemsize])
+                pos += count * values.itemsize
+                arrays.append(values)
+
+            paths = data[pos:].decode('utf8').split('\x00') if count > 0 else []
+            if len(paths) != count or len(arrays[2]) != count:
+                return None
+        except ValueError:
+            logging.warning('Ignoring broken TOC cache entry for "%s".' % vp_path)
+            return None
+
+        # The entry's mtime tells prune() when it was last used.
+        try:
+            os.utime(self._get_name(vp_path))
+        except OSError:
+            pass
+
+        return VpIndex(paths, *arrays), toc_offset
+
+    def store(self, vp_path, info, index, toc_offset):
+        name = os.path.abspath(vp_path).encode('utf8', 'surrogateescape')
+        data = [
+            self.HEADER.pack(self.MAGIC, self.VERSION, info.st_size, info.st_mtime_ns, info.st_ino, toc_offset,
+                len(index), len(name)),
+            name,
+            index.offsets.tobytes(),
+            index.sizes.tobytes(),
+            index.timestamps.tobytes(),
+            '\x00'.join(index.paths).encode('utf8')
+        ]
+
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+            with os.fdopen(fd, 'wb') as stream:
+                stream.write(b''.join(data))
+
+            os.replace(tmp_path, self._get_name(vp_path))
+        except (IOError, OSError):
+            logging.exception('Failed to save the TOC of "%s"!' % vp_path)
+
+    def _read_source(self, path):
+        """Returns the path of the VP the entry at path was created from or None if the entry is unusable."""
+        with open(path, 'rb') as stream:
+            header = stream.read(self.HEADER.size)
+            if len(header) < self.HEADER.size:
+                return None
+
+            values = self.HEADER.unpack(header)
+            if values[0] != self.MAGIC or values[1] != self.VERSION:
+                return None
+
+            return stream.read(values[-1]).decode('utf8', 'surrogateescape')
+
+    def prune(self):
+        """Removes broken and outdated entries, entries for VPs which no longer exist and leftover temporary files.
+
+        If there are still more than max_entries left, the least recently used ones are removed as well.
+        """
+        if not os.path.isdir(self.path):
+            return
+
+        entries = []
+        for item in os.listdir(self.path):
+            path = os.path.join(self.path, item)
+            try:
+                if item.endswith('.toc'):
+                    source = self._read_source(path)
+                    if source is not None and os.path.isfile(source):
+                        entries.append((os.stat(path).st_mtime, path))
+                        continue
+                elif not item.endswith('.tmp'):
+                    continue
+
+                os.unlink(path)
+            except (IOError, OSError, ValueError):
+                logging.warning('Failed to check "%s" in the TOC cache.' % item)
+
+        if len(entries) > self.max_entries:
+            entries.sort()
+            logging.debug('Evicting %d entries from the TOC cache.' % (len(entries) - self.max_entries))
+
+            for mtime, path in entries[:len(entries) - self.max_entries]:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    logging.warning('Failed to remove "%s" from the TOC cache.' % path)
+
+    def clear(self):
+        if not os.path.isdir(self.path):
+            return
+
+        for item in os.listdir(self.path):
+            if item.endswith(('.toc', '.tmp')):
+                try:
+                    os.unlink(os.path.join(self.path, item))
+                except OSError:
+                    logging.warning('Failed to remove "%s" from the TOC cache.' % item)
+
+
+class VpFileView(io.RawIOBase):
+    """A read-only file object over the buffer of a single VP entry.
+
+    Each view keeps its own position so several views (and threads) can read from the same VpReader at once.
+    """
+
+    def __init__(self, buf):
+        super(VpFileView, self).__init__()
+
+        self._buf = buf
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def getbuffer(self):
+        return self._buf
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+
+        end = len(self._buf)
+        if size is not None and size >= 0:
+            end = min(end, self._pos + size)
+
+        data = bytes(self._buf[self._pos:end])
+        self._pos = max(self._pos, end)
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, b):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+
+        chunk = self._buf[self._pos:self._pos + len(b)]
+        size = len(chunk)
+
+        memoryview(b).cast('B')[:size] = chunk
+        self._pos += size
+        return size
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, mode=os.SEEK_SET):
+        if mode == os.SEEK_CUR:
+            pos += self._pos
+        elif mode == os.SEEK_END:
+            pos += len(self._buf)
+
+        if pos < 0:
+            raise ValueError('Negative seek position %d' % pos)
+
+        self._pos = pos
+        return pos
+
+    def close(self):
+        if not self.closed:
+            self._buf.release()
+
+        super(VpFileView, self).close()
+
+
 class VpReader(DataReader):
     fs = None
     files = None
+    toc_offset = 0
+    _path = None
+    _mmap = None
+    _view = None
+    _lock = None
+
+    def __init__(self, filename, use_mmap=True):
+        self._lock = threading.Lock()
+        self._path = filename if isinstance(filename, str) else None
+        super(VpReader, self).__init__(filename)
+
+        if use_mmap and self.files is not None:
+            self._map_file()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def cut_str(self, string):
         length = string.find(b'\x00')
@@ -108,6 +461,22 @@ class VpReader(DataReader):
         return string[:length]
 
     def read(self):
+        cache = TOC_CACHE
+        if cache and self._path:
+            info = os.fstat(self._file.fileno())
+
+            entry = cache.load(self._path, info)
+            if entry:
+                self.files, self.toc_offset = entry
+                return
+
+            self._parse_toc()
+            if self.files is not None:
+                cache.store(self._path, info, self.files, self.toc_offset)
+        else:
+            self._parse_toc()
+
+    def _parse_toc(self):
         header, version, diroffset, direntries = self.unpack('4siii')
 
         if header != b'VPVP':
@@ -118,12 +487,20 @@ class VpReader(DataReader):
         dirs = 0
         files = 0
 
+        self.toc_offset = diroffset
         self._file.seek(diroffset)
-        self.files = {}
-        cur_path = []
-        for n in range(direntries):
-            offset, size, name, timestamp = self.unpack('ii32si')
-            name = self.cut_str(name).decode('utf8').lower()
+        toc = self._file.read(direntries * TOC_ENTRY.size)
+        if len(toc) < direntries * TOC_ENTRY.size:
+            logging.error('The TOC of "{0}" is truncated!'.format(getattr(self._file, 'name', '<stream>')))
+            toc = toc[:len(toc) - len(toc) % TOC_ENTRY.size]
+
+        paths = []
+        offsets = []
+        sizes = []
+        timestamps = []
+        prefixes = ['']
+        for offset, size, name, timestamp in TOC_ENTRY.iter_unpack(toc):
+            name = name.split(b'\x00', 1)[0].decode('utf8').lower()
 
             if timestamp == 0:
                 if size != 0:
@@ -131,119 +508,413 @@ class VpReader(DataReader):
                     continue
 
                 if name == '..':
-                    cur_path.pop()
+                    if len(prefixes) > 1:
+                        prefixes.pop()
                 else:
-                    cur_path.append(name)
+                    prefixes.append(prefixes[-1] + name + '/')
                     dirs += 1
             else:
-                cur_path.append(name)
-                self.files['/'.join(cur_path)] = {
-                    'offset': offset,
-                    'size': size,
-                    'timestamp': timestamp
-                }
-                cur_path.pop()
+                paths.append(prefixes[-1] + name)
+                offsets.append(offset)
+                sizes.append(size)
+                timestamps.append(timestamp)
                 files += 1
 
-        logging.info('Found {0} files and {1} directories in "{2}".'.format(files, dirs, self._file.name))
+        self.files = VpIndex(paths, offsets, sizes, timestamps)
+
+        logging.info('Found {0} files and {1} directories in "{2}".'.format(files, dirs, getattr(self._file, 'name', '<stream>')))
+
+    def _map_file(self):
+        if hasattr(self._file, 'getbuffer'):
+            # This is an in-memory stream or an entry of another VP, we can use its buffer directly.
+            self._view = memoryview(self._file.getbuffer())
+            return
+
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, io.UnsupportedOperation, ValueError, OSError):
+            logging.debug('Failed to mmap "%s", falling back to regular reads.', getattr(self._file, 'name', '<stream>'))
+            return
+
+        self._view = memoryview(self._mmap)
+
+    def get_buffer(self, path):
+        offset, size = self.files.get_entry(path)
+
+        if self._view is not None:
+            return self._view[offset:offset + size]
+
+        # The shared handle can't be mapped so we have to read the whole entry while nobody else moves it.
+        with self._lock:
+            self._file.seek(offset)
+            return memoryview(self._file.read(size))
 
     def open_file(self, path):
-        self._file.seek(self.files[path]['offset'])
-        return self._file
+        return VpFileView(self.get_buffer(path))
+
+    def copy_to(self, path, dest):
+        """Writes the contents of path to the (binary) file object dest.
+
+        This uses positional kernel-side copies where possible so it's safe to call from several threads at once.
+        """
+        offset, size = self.files.get_entry(path)
+        done = 0
+
+        if self._mmap is not None:
+            dest.flush()
+            done = copy_range(self._file.fileno(), offset, size, dest.fileno())
+
+        if done < size:
+            buf = self.get_buffer(path)
+            try:
+                dest.write(buf[done:])
+            finally:
+                buf.release()
+
+        return size
+
+    def close(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Some VpFileView is still open, the map will be closed once the last one is gone.
+                logging.debug('Closing VpReader with open file views.')
+
+            self._mmap = None
+
+        self._file.close()
+
+
+def build_toc(entries):
+    """Generates the TOC for a list of (path tuple, offset, size, timestamp) entries sorted by path.
+
+    Returns a list of (name, offset, size, timestamp, path tuple) items. Directory entries have no path.
+    """
+    toc = []
+    cur_path = ()
+
+    for path, offset, size, timestamp in entries:
+        dirs = path[:-1]
+
+        common = 0
+        while common < len(cur_path) and common < len(dirs) and cur_path[common] == dirs[common]:
+            common += 1
+
+        for i in range(len(cur_path) - common):
+            toc.append(('..', 0, 0, 0, None))
+
+        for name in dirs[common:]:
+            toc.append((name, 0, 0, 0, None))
+
+        cur_path = dirs
+        toc.append((path[-1], offset, size, timestamp, path))
+
+    for i in range(len(cur_path)):
+        toc.append(('..', 0, 0, 0, None))
+
+    return toc
+
+
+def pack_toc(toc):
+    data = []
+    dirs = 0
+    files = 0
+
+    for name, offset, size, timestamp, path in toc:
+        data.append(TOC_ENTRY.pack(offset, size, name.encode('utf8'), timestamp))
+
+        if timestamp == 0:
+            dirs += 1
+        else:
+            files += 1
+
+    return b''.join(data), files, dirs
 
 
 class VpWriter(DataWriter):
+    """Writes a VP in a single pass over the output.
+
+    Entries are only recorded by add_file(). write() precomputes the header from the sizes of all entries so it can
+    stream the header, the file data and the TOC into the output (and into the checksums) without ever reading the
+    VP back.
+    """
     _files = None
     _count = 0
     _written = 0
+    _checksum = True
+    _entry_checksums = False
+    bufsize = 1024 * 1024  # 1 MiB
 
-    def __init__(self, path):
+    def __init__(self, path, checksum=True, entry_checksums=False):
         super(VpWriter, self).__init__(path)
 
         self._files = dict()
+        self._checksum = checksum
+        self._entry_checksums = entry_checksums
 
     def add_file(self, path, content):
-        path = path.replace('\\', '/').split('/')
-        name = path.pop()
-        lvl = self._files
+        path = tuple(path.replace('\\', '/').split('/'))
 
-        while len(path) > 0:
-            lvl = lvl.setdefault(path.pop(0), {})
+        if path not in self._files:
+            self._count += 1
 
-        lvl[name] = ('file', content)
-        self._count += 1
+        self._files[path] = content
 
     def get_file_count(self):
         return self._count
 
-    def write_file(self, name, content, toc):
-        progress.update(self._written / float(self._count), 'Packing "%s"...' % name)
-        self._written += 1
+    def _get_size(self, content):
+        if isinstance(content, str):
+            return os.stat(content).st_size
+        elif hasattr(content, 'getbuffer'):
+            return len(content.getbuffer())
+        else:
+            pos = content.tell()
+            size = content.seek(0, os.SEEK_END) - pos
+            content.seek(pos)
+            return size
+
+    def _build_toc(self, timestamp):
+        entries = []
+        offset = 16  # The data starts right after the header.
 
+        for path in sorted(self._files.keys()):
+            content = self._files[path]
+            size = self._get_size(content)
+            if size == 0:
+                raise EmptyFileException(content)
+
+            entries.append((path, offset, size, timestamp))
+            offset += size
+
+        return build_toc(entries), offset
+
+    def _write_data(self, content, size, hashers):
         if isinstance(content, str):
-            content = open(content, 'rb')
-            opened = True
+            stream = open(content, 'rb')
         else:
-            opened = False
-
-        offset = self._file.tell()
-        shutil.copyfileobj(content, self._file)
-        size = self._file.tell() - offset
-
-        if size == 0:
-            raise EmptyFileException(content)
-
-        if opened:
-            content.close()
-
-        toc.append({
-            'name': name,
-            'offset': offset,
-            'size': size,
-            'timestamp': int(time())
-        })
-
-    def write_dir(self, lvl, toc):
-        for name, content in lvl.items():
-            if isinstance(content, tuple) and content[0] == 'file':
-                # a file
-                self.write_file(name, content[1], toc)
+            stream = content
+
+        try:
+            if hasattr(stream, 'getbuffer'):
+                buf = stream.getbuffer()
+                for h in hashers:
+                    h.update(buf)
+
+                self._file.write(buf)
+                return len(buf)
+
+            if not hashers and hasattr(stream, 'fileno'):
+                try:
+                    src_fd = stream.fileno()
+                except io.UnsupportedOperation:
+                    src_fd = None
+
+                if src_fd is not None:
+                    # Nothing needs to see the data, let the kernel copy it.
+                    self._file.flush()
+                    start = self._file.tell()
+                    done = copy_range(src_fd, stream.tell(), size, self._file.fileno())
+
+                    # Move our file object to the position the kernel left the fd at.
+                    self._file.seek(start + done)
+                    if done == size:
+                        return done
+
+                    stream.seek(done, os.SEEK_CUR)
+                else:
+                    done = 0
             else:
-                toc.append({
-                    'name': name,
-                    'offset': 0,
-                    'size': 0,
-                    'timestamp': 0
-                })
-                self.write_dir(content, toc)
-                toc.append({
-                    'name': '..',
-                    'offset': 0,
-                    'size': 0,
-                    'timestamp': 0
-                })
+                done = 0
+
+            buf = bytearray(self.bufsize)
+            view = memoryview(buf)
+            while True:
+                count = stream.readinto(buf)
+                if not count:
+                    break
+
+                chunk = view[:count]
+                for h in hashers:
+                    h.update(chunk)
+
+                self._file.write(chunk)
+                done += count
+
+            return done
+        finally:
+            if stream is not content:
+                stream.close()
 
     def write(self):
-        self.pack('4siii', b'VPVP', 0, 0, 0)
+        """Writes the VP and closes it.
 
-        toc = []
-        self.write_dir(self._files, toc)
+        Returns a tuple of the VP's checksum (('sha256', hexdigest) or None if checksum is False) and a dict mapping
+        each entry's path to its checksum (empty if entry_checksums is False).
+        """
+        toc, diroffset = self._build_toc(int(time()))
 
-        diroffset = self._file.tell()
-        dirs = 0
-        files = 0
+        vp_hash = hashlib.sha256() if self._checksum else None
+        entry_sums = {}
+        total = float(max(1, diroffset - 16))
+
+        header = struct.pack('<4siii', b'VPVP', 2, diroffset, len(toc))
+        self._file.write(header)
+        if vp_hash:
+            vp_hash.update(header)
+
+        for name, offset, size, timestamp, path in toc:
+            if path is None:
+                continue
+
+            progress.update((offset - 16) / total, 'Packing "%s"...' % name)
+            self._written += 1
+
+            hashers = [vp_hash] if vp_hash else []
+            if self._entry_checksums:
+                entry_hash = hashlib.sha256()
+                hashers.append(entry_hash)
+
+            written = self._write_data(self._files[path], size, hashers)
+            if written != size:
+                raise IOError('The size of "%s" changed while it was packed!' % '/'.join(path))
+
+            if self._entry_checksums:
+                entry_sums['/'.join(path)] = ('sha256', entry_hash.hexdigest())
 
         progress.update(0.99, 'Writing TOC...')
-        for item in toc:
-            self.pack('ii32si', item['offset'], item['size'], item['name'].encode('utf8'), item['timestamp'])
+        toc_data, files, dirs = pack_toc(toc)
+        self._file.write(toc_data)
+        if vp_hash:
+            vp_hash.update(toc_data)
 
-            if item['timestamp'] == 0:
-                dirs += 1
-            else:
-                files += 1
+        self._file.close()
+
+        logging.info('Wrote {0} files and {1} directories in "{2}".'.format(files, dirs, self._file.name))
+
+        return ('sha256', vp_hash.hexdigest()) if vp_hash else None, entry_sums
+
+
+class VpUpdater(VpWriter):
+    """Updates an existing VP by appending new and changed entries followed by a fresh TOC.
+
+    The data of replaced and removed entries stays in the file as dead space. Once needs_compaction() says that
+    there's too much of it, the VP should be rebuilt with VpWriter instead.
+    """
+    compact_ratio = 0.25
+    _old = None
+    _data_end = 0
+    _kept = None
+
+    def __init__(self, path):
+        with VpReader(path, use_mmap=False) as reader:
+            if reader.files is None:
+                raise ValueError('"%s" is not a valid VP file!' % path)
+
+            self._old = reader.files
+            self._data_end = reader.toc_offset
+
+        # The VP is only opened for writing once write() is called.
+        super(VpUpdater, self).__init__(None)
+        self._path = path
+        self._kept = {}
+
+    def _split_path(self, path):
+        return tuple(path.replace('\\', '/').split('/'))
+
+    def add_file(self, path, content):
+        self._kept.pop(self._split_path(path), None)
+        super(VpUpdater, self).add_file(path, content)
+
+    def keep_file(self, path):
+        """Keeps the existing data for path. Returns False if the VP doesn't contain it."""
+        key = path.replace('\\', '/').lower()
+        if key not in self._old:
+            return False
+
+        path = self._split_path(path)
+        if path not in self._files:
+            self._count += 1
+        else:
+            del self._files[path]
+
+        self._kept[path] = key
+        return True
+
+    def get_dead_ratio(self):
+        """Returns the fraction of the data area that would be wasted after write()."""
+        live = sum(self._old.get_entry(key)[1] for key in set(self._kept.values()))
+        old_data = self._data_end - 16
+        new_data = sum(self._get_size(content) for content in self._files.values())
+
+        return (old_data - live) / float(max(1, old_data + new_data))
+
+    def needs_compaction(self):
+        return self.get_dead_ratio() > self.compact_ratio
+
+    def write(self):
+        """Appends the new entries and the TOC, then closes the VP.
+
+        Returns the same tuple as VpWriter.write(). The VP's checksum has to be calculated by reading the whole file
+        back since most of it wasn't written by us. Entry checksums aren't supported.
+        """
+        self._file = open(self._path, 'r+b')
+        timestamp = int(time())
+        paths = sorted(set(self._files.keys()) | set(self._kept.keys()))
+        new_data = float(max(1, sum(self._get_size(content) for content in self._files.values())))
+        entries = []
+        offset = self._data_end
+
+        # This overwrites the old TOC. The VP is broken until we're done.
+        self._file.seek(offset)
+
+        for path in paths:
+            if path in self._kept:
+                info = self._old[self._kept[path]]
+                entries.append((path, info['offset'], info['size'], info['timestamp']))
+                continue
 
+            progress.update((offset - self._data_end) / new_data, 'Packing "%s"...' % path[-1])
+            self._written += 1
+
+            content = self._files[path]
+            size = self._get_size(content)
+            if size == 0:
+                raise EmptyFileException(content)
+
+            if self._write_data(content, size, []) != size:
+                raise IOError('The size of "%s" changed while it was packed!' % '/'.join(path))
+
+            entries.append((path, offset, size, timestamp))
+            offset += size
+
+        progress.update(0.99, 'Writing TOC...')
+        toc = build_toc(entries)
+        toc_data, files, dirs = pack_toc(toc)
+
+        self._file.write(toc_data)
+        self._file.truncate()
         self._file.seek(0)
-        self.pack('4siii', b'VPVP', 2, diroffset, len(toc))
+        self._file.write(struct.pack('<4siii', b'VPVP', 2, offset, len(toc)))
         self._file.close()
 
-        logging.info('Wrote {0} files and {1} directories in "{2}".'.format(files, dirs, self._file.name))
+        logging.info('Appended {0} of {1} files to "{2}".'.format(len(self._files), files, self._file.name))
+
+        vp_hash = hashlib.sha256()
+        with open(self._file.name, 'rb') as stream:
+            buf = bytearray(self.bufsize)
+            view = memoryview(buf)
+
+            while True:
+                count = stream.readinto(buf)
+                if not count:
+                    break
+
+                vp_hash.update(view[:count])
+
+        return ('sha256', vp_hash.hexdigest()), {}
@@ -298,6 +298,7 @@ class HellWindow(Window):
 
         center.signals.update_avail.connect(self.ask_update)
         center.signals.task_launched.connect(self.watch_task)
+        center.signals.mod_list_changed.connect(self.update_mod_list)
 
         self.win.setWindowTitle(self.win.windowTitle() + ' ' + center.VERSION)
         self.win.titleBar.setText(self.win.windowTitle())
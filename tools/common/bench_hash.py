@@ -0,0 +1,69 @@
+## Copyright 2017 Knossos authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+"""
+Compares the throughput of the hashing strategies in knossos.util.hash_file().
+
+Usage: python tools/common/bench_hash.py [file or size in MiB]
+
+Pass an existing (large) file to measure the real disk. Otherwise a temporary file is generated which will most likely
+be served from the page cache.
+"""
+
+import sys
+import os.path
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from knossos import util  # noqa
+
+
+def run(path, strategy, algos):
+    start = time.perf_counter()
+    util.hash_file(path, algos, strategy)
+    return time.perf_counter() - start
+
+
+def main():
+    arg = sys.argv[1] if len(sys.argv) > 1 else '512'
+    tmp = None
+
+    if os.path.isfile(arg):
+        path = arg
+    else:
+        fd, path = tempfile.mkstemp(suffix='.bin')
+        tmp = path
+
+        with os.fdopen(fd, 'wb') as stream:
+            block = os.urandom(1024 * 1024)
+            for i in range(int(arg)):
+                stream.write(block)
+
+    try:
+        size = os.stat(path).st_size / (1024. * 1024.)
+        print('Hashing %s (%.1f MiB):' % (path, size))
+
+        for algos in (('sha256',), ('sha256', 'md5')):
+            for strategy in ('read', 'readinto', 'mmap'):
+                duration = run(path, strategy, algos)
+                print('%-15s %-10s %8.1f MB/s' % ('+'.join(algos), strategy, size / duration))
+    finally:
+        if tmp:
+            os.unlink(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+## Copyright 2017 Knossos authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+"""
+Micro-benchmarks for knossos.vplib.
+
+Usage: python tools/common/bench_vplib.py [entries]
+"""
+
+import sys
+import os.path
+import struct
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+# vplib imports progress which imports center and util. util imports vplib so it has to be loaded first.
+from knossos import util  # noqa
+from knossos import vplib  # noqa
+
+
+def build_vp(path, entries):
+    # Only the TOC matters for these benchmarks so every file points at the same 4 bytes of data.
+    per_dir = 1000
+
+    with open(path, 'wb') as stream:
+        stream.write(struct.pack('<4siii', b'VPVP', 2, 0, 0))
+        stream.write(b'data')
+
+        toc = []
+        for d in range(0, entries, per_dir):
+            toc.append(struct.pack('<ii32si', 0, 0, b'dir%d' % d, 0))
+
+            for n in range(d, min(d + per_dir, entries)):
+                toc.append(struct.pack('<ii32si', 16, 4, b'file%d.tbl' % n, 1500000000))
+
+            toc.append(struct.pack('<ii32si', 0, 0, b'..', 0))
+
+        diroffset = stream.tell()
+        stream.write(b''.join(toc))
+        stream.seek(0)
+        stream.write(struct.pack('<4siii', b'VPVP', 2, diroffset, len(toc)))
+
+
+def legacy_read(path):
+    # The old VpReader.read() implementation: one unpack() and one dict per entry.
+    files = {}
+
+    with open(path, 'rb') as stream:
+        header, version, diroffset, direntries = struct.unpack('<4siii', stream.read(16))
+        stream.seek(diroffset)
+
+        cur_path = []
+        for n in range(direntries):
+            offset, size, name, timestamp = struct.unpack('<ii32si', stream.read(44))
+            length = name.find(b'\x00')
+            if length != -1:
+                name = name[:length]
+
+            name = name.decode('utf8').lower()
+
+            if timestamp == 0:
+                if name == '..':
+                    cur_path.pop()
+                else:
+                    cur_path.append(name)
+            else:
+                cur_path.append(name)
+                files['/'.join(cur_path)] = {
+                    'offset': offset,
+                    'size': size,
+                    'timestamp': timestamp
+                }
+                cur_path.pop()
+
+    return files
+
+
+def measure(label, fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    duration = time.perf_counter() - start
+
+    tracemalloc.start()
+    result = fn(*args)
+    mem = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print('%-20s %8.1f ms %10.1f KiB' % (label, duration * 1000, mem / 1024.))
+    return result
+
+
+def main():
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.vp')
+        build_vp(path, entries)
+
+        print('Parsing a VP with %d entries:' % entries)
+        measure('legacy dict', legacy_read, path)
+        reader = measure('VpReader', vplib.VpReader, path, False)
+        reader.close()
+
+        vplib.TOC_CACHE = vplib.TocCache(os.path.join(tmp, 'cache'))
+        vplib.VpReader(path, False).close()
+        reader = measure('VpReader (cached)', vplib.VpReader, path, False)
+        reader.close()
+        vplib.TOC_CACHE = None
+
+
+if __name__ == '__main__':
+    main()